@@ -0,0 +1,462 @@
+"""Benchmark the bugmonitor.py ingest with a synthetic mail corpus.
+
+The messages are generated on the fly by a fake IMAP server, and the
+evaluations come from a fake suse.bugzilla module, so nothing leaves
+the process. Every size runs in a fresh process and database, through
+the Pipeline of the live ingest. The report shows the throughput, the
+time each message waits (from the submission of its parsed chunk to
+its evaluation), the time of its evaluation, and the peak memory.
+
+With --classify, the corpus (plus reopened bugs) is classified with
+the rule table of bugmonitor and with the predicates it replaced, and
+the run fails if any message gets a different action.
+
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+
+SIZES = (10000, 100000, 1000000)
+
+# Relative frequency of each kind of message
+MIX = {
+    'new': 1,
+    'fix': 1,
+    'comment': 3,
+    'obs': 1,
+    'whiteboard': 1,
+}
+
+# Number of distinct bugs and users in the corpus
+BUGS  = 5000
+USERS = 200
+
+# UIDs returned by each IMAP search, like successive IDLE wake-ups
+BATCH = 10000
+
+# Latency histogram resolution (buckets per factor of e)
+RESOLUTION = 20
+
+# Messages checked by --classify, and size of the padded bodies
+CLASSIFY_SIZE    = 20000
+CLASSIFY_PADDING = 20 * 1024
+
+
+class FakeBug(object):
+    """Bug returned by FakeBugzilla."""
+
+    def __init__(self, bugid):
+        self.bug_id = str(bugid)
+        self.summary = 'Synthetic bug %s' % bugid
+        self.classification = 'openSUSE'
+        self.product = 'openSUSE 13.1'
+        evaluation = ('GOLD', 'SILVER', 'BRONZE', None)[int(bugid) % 4]
+        if evaluation:
+            self.status_whiteboard = evaluation
+
+
+class FakeBugzilla(object):
+    """Replacement for suse.bugzilla.Bugzilla, with a fixed latency."""
+
+    latency = 0.0
+    requests = 0
+
+    def __init__(self, *args, **kwargs):
+        self.browser = self
+
+    def add_password(self, *args):
+        pass
+
+    def get_bugs(self, ids):
+        FakeBugzilla.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [FakeBug(bugid) for bugid in ids]
+
+
+def install_fake_bugzilla():
+    """Make `import suse.bugzilla` return the fake module."""
+    suse = types.ModuleType('suse')
+    suse.bugzilla = types.ModuleType('suse.bugzilla')
+    suse.bugzilla.Bugzilla = FakeBugzilla
+    sys.modules['suse'] = suse
+    sys.modules['suse.bugzilla'] = suse.bugzilla
+
+
+# X-Bugzilla-Type, X-Bugzilla-Changed-Fields, X-Bugzilla-Status and
+# body of each kind of message
+KINDS = {
+    'new': ('new', '', 'NEW', ''),
+    'fix': ('changed', 'Status Resolution', 'RESOLVED',
+            '           What    |Removed                     |Added\n'
+            '----------------------------------------------------------------\n'
+            '             Status|NEW                         |RESOLVED\n'
+            '         Resolution|                            |FIXED\n'),
+    'comment': ('changed', '', 'NEW',
+                '--- Comment #3 from Some User <user@example.com> ---\n'),
+    'obs': ('changed', '', 'NEW',
+            '--- Comment #4 from Bernhard Wiedemann <bwiedemann@suse.com> ---\n'
+            'This is an autogenerated message for OBS integration:\n'
+            'This bug (%(bugid)d) was mentioned in\n'
+            'https://build.opensuse.org/request/show/12345 Factory / pkg\n'),
+    'whiteboard': ('changed', 'Whiteboard', 'NEW',
+                   '           What    |Removed                     |Added\n'
+                   '----------------------------------------------------------------\n'
+                   '   Status Whiteboard|                           |GOLD\n'),
+    'reopen': ('changed', 'Status Resolution', 'REOPENED',
+               '           What    |Removed                     |Added\n'
+               '----------------------------------------------------------------\n'
+               '             Status|RESOLVED                    |REOPENED\n'
+               '         Resolution|FIXED                       |---\n'),
+}
+
+HEADER = '''Return-Path: <bugzilla_noreply@novell.com>
+Received: from smtp.example.com (smtp.example.com [10.0.0.1])
+        by mx.example.com with ESMTP id %(uid)d
+        for <bugbot@example.com>; Fri, 27 Sep 2013 10:00:00 +0200
+Date: Fri, 27 Sep 2013 10:00:00 +0000
+From: bugzilla_noreply@novell.com
+To: bugbot@example.com
+Subject: [Bug %(bugid)d] Synthetic bug %(bugid)d
+Message-ID: <bug-%(bugid)d-%(uid)d@http.bugzilla.novell.com/>
+X-Bugzilla-Reason: AssignedTo
+X-Bugzilla-Type: %(type)s
+X-Bugzilla-Watch-Reason: None
+X-Bugzilla-Classification: openSUSE
+X-Bugzilla-Product: openSUSE 13.1
+X-Bugzilla-Component: Basesystem
+X-Bugzilla-Keywords:
+X-Bugzilla-Severity: Normal
+X-Bugzilla-Who: user%(user)d@example.com
+X-Bugzilla-Status: %(status)s
+X-Bugzilla-Priority: P5 - None
+X-Bugzilla-Assigned-To: maintainer@example.com
+X-Bugzilla-Target-Milestone: ---
+X-Bugzilla-Changed-Fields: %(fields)s
+X-Bugzilla-Foundby: ---
+X-Bugzilla-Version: 13.1
+MIME-Version: 1.0
+Content-Type: text/plain; charset="UTF-8"
+
+'''.replace('\n', '\r\n')
+
+BODY = '''https://bugzilla.novell.com/show_bug.cgi?id=%(bugid)d
+
+%(text)s
+Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim
+veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea
+commodo consequat.
+
+--
+You are receiving this mail because:
+You are the assignee for the bug.
+'''
+
+
+class Corpus(object):
+    """Deterministic synthetic Bugzilla mails.
+
+    Message `uid` (starting at 1) is generated when asked, so the size
+    of the corpus does not change the memory used by the generator.
+
+    """
+
+    def __init__(self, size, mix=MIX, start=None, stop=None):
+        self.size = size
+        self.kinds = []
+        for kind, weight in sorted(mix.iteritems()):
+            self.kinds.extend([kind] * weight)
+        self.start = start
+        self.step = (stop - start) // size
+
+    def kind(self, uid):
+        return self.kinds[(uid * 7919) % len(self.kinds)]
+
+    def message(self, uid):
+        """Return the IMAP FETCH data of a message."""
+        bugid = 800000 + (uid * 104729) % BUGS
+        type_, fields, status, text = KINDS[self.kind(uid)]
+        values = {
+            'uid': uid,
+            'bugid': bugid,
+            'user': (uid * 31) % USERS,
+            'type': type_,
+            'status': status,
+            'fields': fields,
+        }
+        values['text'] = text % values
+        return {
+            'INTERNALDATE': self.start + self.step * (uid - 1),
+            'ENVELOPE': (None, '[Bug %(bugid)d] Synthetic bug %(bugid)d' % values),
+            'BODY[HEADER]': HEADER % values,
+            'BODY[TEXT]': BODY % values,
+        }
+
+
+class FakeIMAP(object):
+    """In-process replacement for the IMAPClient used by bugmonitor."""
+
+    Error = Exception
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.fetched = 0
+
+    def search(self, criteria):
+        return range(1, self.corpus.size + 1)
+
+    def fetch(self, uids, items):
+        result = {}
+        for uid in uids:
+            msg = self.corpus.message(uid)
+            data = {}
+            for item in items:
+                key = item.replace('.PEEK', '')
+                data[key] = msg[key]
+            result[uid] = data
+        self.fetched += len(uids)
+        return result
+
+    def add_flags(self, uids, flags):
+        pass
+
+
+class Histogram(object):
+    """Logarithmic histogram of latencies, in constant memory."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, seconds):
+        bucket = int(math.floor(math.log(max(seconds, 1e-7)) * RESOLUTION))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def percentile(self, p):
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                return math.exp((bucket + 1.0) / RESOLUTION)
+        return 0.0
+
+
+def run(size, dbname, mix=MIX, compact=False, latency=0.0, batch=BATCH):
+    """Ingest `size` synthetic messages, and measure it.
+
+    Returns:
+        Dictionary with the results.
+
+    """
+    install_fake_bugzilla()
+    FakeBugzilla.latency = latency
+    import bugmonitor
+
+    bugmonitor.initdb(dbname, compact=compact)
+    conn = bugmonitor.connect(dbname)
+    bugmonitor.upgradedb(conn)
+    bugmonitor._cache = bugmonitor.EvaluationCache(dbname)
+
+    srv = FakeIMAP(Corpus(size, mix, bugmonitor.START, bugmonitor.STOP))
+    pipeline = bugmonitor.Pipeline(dbname)
+    waits = Histogram()
+    evaluations = Histogram()
+
+    # Time each message from the submission of its chunk (fetched and
+    # parsed) to its evaluation by the writer, and the evaluation itself
+    submitted = {}
+    submit = pipeline.submit
+    def timed_submit(uids, bugs, done=None):
+        now = time.time()
+        for bug in bugs:
+            submitted[id(bug)] = now
+        submit(uids, bugs, done)
+    pipeline.submit = timed_submit
+
+    evaluate = bugmonitor.evaluate
+    def timed_evaluate(conn, bug, bot, events=None):
+        start = time.time()
+        waits.add(start - submitted.pop(id(bug), start))
+        evaluate(conn, bug, bot, events)
+        evaluations.add(time.time() - start)
+    bugmonitor.evaluate = timed_evaluate
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        msgids = srv.search(None)
+        for i in range(0, len(msgids), batch):
+            pipeline.run(srv, msgids[i:i+batch])
+        ingest = time.time() - start
+
+        start = time.time()
+        bugmonitor.ranking(dbname)
+        ranking = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    return {
+        'messages': size,
+        'seconds': ingest,
+        'rate': size / ingest,
+        'wait_p50': waits.percentile(50),
+        'wait_p99': waits.percentile(99),
+        'eval_p50': evaluations.percentile(50),
+        'eval_p99': evaluations.percentile(99),
+        'ranking': ranking,
+        'bz_requests': FakeBugzilla.requests,
+        'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'db_kb': os.path.getsize(dbname) // 1024,
+    }
+
+
+def reference_action(bug):
+    """Classify a bug action with the predicates replaced by the
+    bugmonitor Classifier (is_fix, is_scr, is_new, is_auto,
+    is_suspicious and is_reopen), with the reopen check corrected and
+    the new bugs with the OBS marker excluded, as in the RULES."""
+    body = bug.body or ''
+    comment = '--- Comment #' in body
+    obs = 'This is an autogenerated message for OBS integration' in body
+    closed = bug.status in ('CLOSED', 'RESOLVED')
+    if (bug.type == 'changed' and 'Status' in bug.changed_fields and
+            'Resolution' in bug.changed_fields and closed):
+        return 'FIX'
+    if ((bug.type == 'changed' and not closed and comment) or
+            bug.type == 'new') and not obs:
+        return 'SCR/NEW'
+    if bug.type == 'changed' and 'Whiteboard' in bug.changed_fields:
+        return 'SUSPICIOUS/REOPEN'
+    if (bug.type == 'changed' and 'Status' in bug.changed_fields and
+            not closed and re.search(r'Status\|\s*(?:CLOSED|RESOLVED)\s*\|', body)):
+        return 'SUSPICIOUS/REOPEN'
+    return 'OTHER'
+
+
+def check_classifier(size, mix, padding=0):
+    """Classify a corpus with the rule table and with reference_action().
+
+    Every message gets its body, padded with `padding` bytes.
+
+    Returns:
+        A (mismatches, table, reference) tuple, with the number of
+        messages classified differently, and the time per message of
+        each classification, in seconds
+
+    """
+    install_fake_bugzilla()
+    import bugmonitor
+
+    corpus = Corpus(size, mix, bugmonitor.START, bugmonitor.STOP)
+    bugs = []
+    for uid in range(1, size + 1):
+        bug = bugmonitor.process_msg(corpus.message(uid))
+        bug.set_body(bug.body + 'x' * padding)
+        bugs.append(bug)
+
+    start = time.time()
+    actions = [bugmonitor._rules.classify(bug, 'OTHER')[0] for bug in bugs]
+    table = time.time() - start
+
+    start = time.time()
+    expected = [reference_action(bug) for bug in bugs]
+    reference = time.time() - start
+
+    mismatches = sum(1 for a, b in zip(actions, expected) if a != b)
+    return mismatches, table / size, reference / size
+
+
+def _child(queue, *args):
+    queue.put(run(*args))
+
+
+def run_isolated(*args):
+    """Call run() in a new process, so that the peak memory is its own."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_child, args=(queue,) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def parse_mix(value):
+    """Parse a mix like 'new=1,fix=1,comment=3'."""
+    mix = {}
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError('unknown kind: %s' % kind)
+        mix[kind] = int(weight)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the bugmonitor ingest.')
+    parser.add_argument('-n', '--messages', type=int, action='append',
+                        help='number of messages (can be repeated, '
+                        'default %s)' % ', '.join(str(s) for s in SIZES))
+    parser.add_argument('--mix', type=parse_mix, default=MIX,
+                        help='relative frequency of each kind of message '
+                        '(default %s)' % ','.join('%s=%d' % i for i in sorted(MIX.items())))
+    parser.add_argument('--compact', action='store_true',
+                        help='use the compact timeline format')
+    parser.add_argument('--bz-latency', type=float, default=0.0,
+                        help='seconds added to each Bugzilla request')
+    parser.add_argument('--batch', type=int, default=BATCH,
+                        help='UIDs returned by each IMAP search')
+    parser.add_argument('--dir', help='directory for the databases '
+                        '(default a temporary one)')
+    parser.add_argument('--classify', action='store_true',
+                        help='check that the classification rules give the '
+                        'same actions as the old predicates, time both, and exit')
+    args = parser.parse_args()
+
+    if args.classify:
+        mix = dict(args.mix, reopen=args.mix.get('reopen', 1))
+        print '%10s %10s %10s %10s %10s' % (
+            'messages', 'body KB', 'mismatches', 'rules us', 'old us')
+        failed = False
+        for size in args.messages or (CLASSIFY_SIZE,):
+            for padding in (0, CLASSIFY_PADDING):
+                mismatches, table, reference = check_classifier(size, mix, padding)
+                print '%10d %10s %10d %10.1f %10.1f' % (
+                    size, '+%d' % (padding // 1024), mismatches,
+                    table * 1e6, reference * 1e6)
+                failed = failed or mismatches
+        if failed:
+            raise SystemExit(1)
+        sys.exit(0)
+
+    directory = args.dir or tempfile.mkdtemp(prefix='bugbot-benchmark-')
+    print '%10s %10s %10s %10s %10s %10s %10s %10s %10s %10s' % (
+        'messages', 'seconds', 'msgs/s', 'wait50 ms', 'wait99 ms',
+        'eval50 us', 'eval99 us', 'ranking ms', 'peak MB', 'db MB')
+    try:
+        for size in args.messages or SIZES:
+            dbname = os.path.join(directory, 'benchmark-%d.db' % size)
+            r = run_isolated(size, dbname, args.mix, args.compact,
+                             args.bz_latency, args.batch)
+            print '%10d %10.1f %10.0f %10.2f %10.2f %10.1f %10.1f %10.1f %10.1f %10.1f' % (
+                r['messages'], r['seconds'], r['rate'], r['wait_p50'] * 1000,
+                r['wait_p99'] * 1000, r['eval_p50'] * 1e6, r['eval_p99'] * 1e6,
+                r['ranking'] * 1000, r['peak_kb'] / 1024.0, r['db_kb'] / 1024.0)
+            sys.stdout.flush()
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
@@ -1,21 +1,33 @@
 import argparse
-from datetime import datetime
+import asyncore
+import BaseHTTPServer
+import cgi
+import collections
+import contextlib
+from datetime import datetime, timedelta
+import hashlib
+import email.utils
+import json
+import mmap
+import multiprocessing
+import os
+import Queue
 import re
+import socket
+import SocketServer
+import sys
 import threading
 import time
 import sqlite3
+import urlparse
+import zlib
 
 from imapclient import IMAPClient
 
 import irc.bot
 import irc.strings
 
-try:
-    import suse.bugzilla
-except ImportError, e:
-    print """*** please git clone git://bolzano/suse/solid-ground
-*** then symlink the suse subdir here"""
-    raise
+import bzclient
 
 
 # IMAP parameters
@@ -27,6 +39,7 @@ IMAP_PASSWORD = ''
 BZ_HOST     = 'https://apibugzilla.novell.com'
 BZ_USERNAME = ''
 BZ_PASSWORD = ''
+BZ_SHOW_BUG = 'https://bugzilla.novell.com/show_bug.cgi?id=%s'
 
 # IRC Parameters
 IRC_HOST    = 'irc.freenode.org'
@@ -34,11 +47,52 @@ IRC_PORT    = 6667
 IRC_NICK    = 'Furcifer'
 IRC_CHANNEL = '#opensuse-pizza-hackaton'
 
+# IRC flood control: messages per second, burst size, and number of
+# pending announcements that triggers the merge into summaries
+IRC_RATE  = 1.0
+IRC_BURST = 4
+IRC_MERGE = 8
+
+# Maximum number of bnc#NNN mentions answered for a single line
+IRC_MENTIONS = 5
+
 START = datetime(2013, 9, 27)
 STOP  = datetime(2013, 9, 28)
 
 DBNAME = 'bugmonitor.db'
 
+# Only messages from this sender are processed
+BZ_SENDER = 'bugzilla_noreply@novell.com'
+
+# Maximum number of messages fetched from IMAP in a single request
+FETCH_CHUNK = 200
+
+# Ingest pipeline: chunks waiting between two stages, and number of
+# concurrent Bugzilla evaluation workers
+PIPELINE_DEPTH = 4
+BZ_WORKERS     = 4
+
+# Number of timeline rows classified by each replay task
+REPLAY_CHUNK = 10000
+
+# Number of archived messages parsed by each import task
+IMPORT_CHUNK = 1000
+
+# Length of the intervals of the ranking history, in seconds
+RANKING_INTERVAL = 300
+
+# Results in each page of a full-text search, and number of most recent
+# matches sorted by relevance
+SEARCH_PAGE   = 5
+SEARCH_WINDOW = 2000
+
+# Evaluation cache parameters
+CACHE_SIZE = 4096
+CACHE_TTL  = 6 * 3600
+# Seconds a bug that Bugzilla did not return (private or deleted) is
+# counted as OTHER before asking again
+MISSING_TTL = 600
+
 # Points table
 TABLE = {
     'FIX GOLD':  100,
@@ -53,19 +107,230 @@ TABLE = {
 
 HTML = '/suse/aplanas/Export/table.html'
 
+# Name of the event made of START, STOP, TABLE, IRC_CHANNEL and HTML,
+# used when no event is configured (see --events)
+EVENT = 'default'
+
+# Embedded HTTP server. Maximum time a long-poll or an event stream
+# waits before answering, in seconds
+HTTP_PORT = None
+HTTP_WAIT = 60
+
+# Push ingestion: raw mails waiting to be processed, largest accepted
+# mail, and maximum number of mails and seconds to batch together
+PUSH_PORT  = None
+PUSH_QUEUE = 10000
+PUSH_SIZE  = 4 * 1024 * 1024
+PUSH_BATCH = FETCH_CHUNK
+PUSH_DELAY = 0.5
+
+
+class Metrics(object):
+    """Counters, timers and gauges of the monitor loop.
+
+    A timer keeps the count, the sum and the maximum of its values, so
+    recording one costs a few dictionary updates, and the metrics can
+    stay enabled in production. The names end with their unit (e.g.
+    `imap_fetch_seconds`, `fetch_batch_messages`). A gauge is a
+    function, only called when the metrics are exported.
+
+    Any thread can record metrics.
+
+    """
+
+    PREFIX = 'bugbot_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.gauges = {}
+
+    def count(self, name, value=1):
+        """Add `value` to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Add a value to a timer."""
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer:
+                timer[0] += 1
+                timer[1] += value
+                timer[2] = max(timer[2], value)
+            else:
+                self.timers[name] = [1, value, value]
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Add the time spent in a `with` block to a timer."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def gauge(self, name, function):
+        """Register a gauge, whose value is returned by `function`."""
+        self.gauges[name] = function
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted((name, list(t)) for name, t in self.timers.items())
+        for name, value in counters:
+            name = self.PREFIX + name + '_total'
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %s' % (name, value))
+        for name, (count, total, maximum) in timers:
+            name = self.PREFIX + name
+            lines.append('# TYPE %s summary' % name)
+            lines.append('%s_count %d' % (name, count))
+            lines.append('%s_sum %.6f' % (name, total))
+            lines.append('# TYPE %s_max gauge' % name)
+            lines.append('%s_max %.6f' % (name, maximum))
+        for name, function in sorted(self.gauges.items()):
+            name = self.PREFIX + name
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, function()))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Write the metrics in a file, replacing it atomically."""
+        with open(filename + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.rename(filename + '.tmp', filename)
+
+    def summary(self):
+        """Return a line of text for each counter and timer."""
+        with self._lock:
+            lines = ['%s: %s' % i for i in sorted(self.counters.items())]
+            for name, (count, total, maximum) in sorted(self.timers.items()):
+                if name.endswith('_seconds'):
+                    lines.append('%s: Count: %d Avg: %.0fms Max: %.0fms' % (
+                        name[:-8], count, total / count * 1000, maximum * 1000))
+                else:
+                    lines.append('%s: Count: %d Avg: %.1f Max: %d' % (
+                        name, count, total / count, maximum))
+        return lines
+
+
+_metrics = Metrics()
+
+
+class OutputQueue(object):
+    """Outgoing IRC messages, paced with a token bucket.
+
+    Replies to commands go ahead of the channel announcements. When
+    more than `merge` announcements are waiting, the ones of the same
+    kind are merged into a single summary line.
+
+    Any thread can add messages. They are sent by pop(), called from
+    the thread that runs the IRC reactor. An announcement keeps the
+    delivery dates of the mails it tells about, so the delay is measured
+    when it is sent.
+
+    """
+
+    SUMMARIES = {
+        'fix': '%d bugs fixed in the last %ds!',
+        'scr': '%d bugs with more information in the last %ds!',
+        'new': '%d new bugs in the last %ds!',
+    }
+
+    def __init__(self, rate=IRC_RATE, burst=IRC_BURST, merge=IRC_MERGE):
+        self.rate = rate
+        self.burst = burst
+        self.merge = merge
+        self._tokens = burst
+        self._stamp = time.time()
+        self._replies = collections.deque()
+        self._announcements = collections.deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._replies) + len(self._announcements)
+
+    def reply(self, target, msg):
+        """Queue a notice to a user."""
+        with self._lock:
+            self._replies.append(('notice', target, msg, ()))
+
+    def announce(self, target, msg, kind=None, date_=None):
+        """Queue a message to a channel. `kind` allows merging it, and
+        `date_` is the delivery date of the mail it tells about."""
+        dates = (date_,) if date_ else ()
+        with self._lock:
+            self._announcements.append((time.time(), target, msg, kind, dates))
+
+    def _summarize(self):
+        now = time.time()
+        groups = collections.OrderedDict()
+        for item in self._announcements:
+            stamp, target, msg, kind, dates = item
+            key = (target, kind) if kind in self.SUMMARIES else (target, msg)
+            groups.setdefault(key, []).append(item)
+        self._announcements.clear()
+        for (target, _), items in groups.iteritems():
+            stamp, _, msg, kind, _ = items[0]
+            dates = tuple(date_ for item in items for date_ in item[4])
+            if len(items) > 1 and kind in self.SUMMARIES:
+                msg = self.SUMMARIES[kind] % (len(items), max(1, now - stamp))
+            self._announcements.append((stamp, target, msg, None, dates))
+
+    def pop(self):
+        """Return the next (method, target, msg, dates) allowed to be
+        sent, or None. `dates` has the delivery dates of the mails of an
+        announcement."""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens < 1:
+                return None
+            if self._replies:
+                item = self._replies.popleft()
+            elif self._announcements:
+                if len(self._announcements) > self.merge:
+                    self._summarize()
+                _, target, msg, _, dates = self._announcements.popleft()
+                item = ('privmsg', target, msg, dates)
+            else:
+                return None
+            self._tokens -= 1
+            return item
+
 
 class BugBot(irc.bot.SingleServerIRCBot):
-    def __init__(self, channel, nickname, server, port=6667, dbname=None):
+    """IRC bot of the events.
+
+    It joins the channel of every event. A command sent in a channel
+    is about the (first) event of that channel, and a private command
+    about the first event.
+
+    """
+
+    def __init__(self, channels, nickname, server, port=6667, dbname=None):
         irc.bot.SingleServerIRCBot.__init__(self, [(server, port)], nickname,
                                             nickname)
-        self.channel = channel
+        self.event_channels = channels
         self.dbname = dbname
+        self.pipeline = None
+        # Mails delivered before are not live, their delay is not measured
+        self.started = datetime.now()
+        self.queue = OutputQueue()
+        self.titles = TitleLookup(self.on_title)
+        self.connection.execute_every(1.0 / (4 * IRC_RATE), self.flush)
 
     def on_nicknameinuse(self, c, e):
         c.nick(c.get_nickname() + '_')
 
     def on_welcome(self, c, e):
-        c.join(self.channel)
+        for channel in self.event_channels:
+            c.join(channel)
 
     def on_privmsg(self, c, e):
         self.do_command(e, e.arguments[0])
@@ -74,46 +339,145 @@ class BugBot(irc.bot.SingleServerIRCBot):
         a = e.arguments[0].split(':', 1)
         if len(a) > 1 and irc.strings.lower(a[0]) == irc.strings.lower(self.connection.get_nickname()):
             self.do_command(e, a[1].strip())
-        return
+            return
+
+        bugids = []
+        for bugid in _MENTION.findall(e.arguments[0]):
+            if bugid not in bugids:
+                bugids.append(bugid)
+        if bugids:
+            self.titles.request(bugids[:IRC_MENTIONS], e.target)
+
+    def on_title(self, target, bugid, title):
+        """Answer a bnc#NNN mention, called when the title is known."""
+        self.reply(target, "bnc#%s is '%s' - %s" % (bugid, title, BZ_SHOW_BUG % bugid))
+
+    def event(self, target):
+        """Return the event of a channel, or the first event."""
+        for event in _events:
+            if event.channel and irc.strings.lower(event.channel) == irc.strings.lower(target):
+                return event
+        return _events[0]
 
     def do_command(self, e, cmd):
         nick = e.source.nick
-        c = self.connection
+        event = self.event(e.target)
 
         if cmd == 'help':
-            c.notice(nick, 'help -- list of commands')
-            c.notice(nick, 'ranking -- show the top 20 of the ranking')
-        elif cmd == 'ranking':
-            table = ranking(self.dbname)
+            self.reply(nick, 'help -- list of commands')
+            self.reply(nick, 'events -- list the events')
+            self.reply(nick, 'ranking -- show the top 20 of the ranking')
+            self.reply(nick, 'ranking <[YYYY-MM-DD] HH:MM> -- show the top 20 at that time')
+            self.reply(nick, 'rank <user> -- show the position of a user')
+            self.reply(nick, 'search <terms> [page N] -- search the bug mails (the subjects, '
+                       'and only the bodies the ranking reads: no fixes)')
+            self.reply(nick, 'bnc#NNN in the channel -- show the title of a bug')
+        elif cmd == 'events':
+            for item in _events:
+                self.reply(nick, '%s: %s - %s%s%s%s' % (
+                    item.name,
+                    item.start.strftime('%Y-%m-%d %H:%M'),
+                    item.stop.strftime('%Y-%m-%d %H:%M'),
+                    ' ' + item.classification if item.classification else '',
+                    ' ' + item.product if item.product else '',
+                    ' in ' + item.channel if item.channel else ''))
+        elif cmd == 'ranking' or cmd.startswith('ranking '):
+            at = None
+            if cmd != 'ranking':
+                at = parse_time(cmd[8:].strip(), event.start)
+                if not at:
+                    self.reply(nick, 'Not a time: ' + cmd[8:].strip())
+                    return
+            table = ranking(self.dbname, limit=20, at=at, event=event.name)
             hstr = '%20s %3s %3s %3s %3s %3s %3s %3s %3s %3s %3s %6s'
             fstr = '%20s %3d %3d %3d %3d %3d %3d %3d %3d %3d %3d %6d'
-            c.notice(nick, hstr % ('User', 'FG', 'FS', 'FB', 'FO', 'SG', 'SS', 'SB', 'SO', 'Susp', 'Other', 'Points'))
-            for t in table[:20]:
-                c.notice(nick, fstr % tuple(t))
-                time.sleep(1)
+            self.reply(nick, hstr % ('User', 'FG', 'FS', 'FB', 'FO', 'SG', 'SS', 'SB', 'SO', 'Susp', 'Other', 'Points'))
+            for t in table:
+                self.reply(nick, fstr % tuple(t))
+        elif cmd.startswith('search '):
+            terms, page = cmd[7:].strip(), 1
+            match = re.match(r'(.*?)\s+page\s+(\d+)$', terms)
+            if match:
+                terms, page = match.group(1), max(int(match.group(2)), 1)
+            found = search(self.dbname, terms, page)
+            if found is None:
+                self.reply(nick, 'Search not available')
+                return
+            results, more = found
+            if not results:
+                self.reply(nick, 'Nothing found for: ' + terms)
+            for date_, bugid, who, subject in results:
+                self.reply(nick, '%s BNC#%s %s: %s' % (date_[:16], bugid, who, subject))
+            if more:
+                self.reply(nick, "More with 'search %s page %d'" % (terms, page + 1))
+        elif cmd.startswith('rank '):
+            user = cmd[5:].strip()
+            position = rank(self.dbname, user, event.name)
+            if position:
+                self.reply(nick, '%s is #%d with %d points' % ((user,) + position))
+            else:
+                self.reply(nick, '%s is not in the ranking' % user)
         elif cmd == '_disconnect':
             self.disconnect()
         elif cmd == '_die':
             self.die()
         elif cmd == '_stats':
             for chname, chobj in self.channels.items():
-                c.notice(nick, '--- Channel statistics ---')
-                c.notice(nick, 'Channel: ' + chname)
+                self.reply(nick, '--- Channel statistics ---')
+                self.reply(nick, 'Channel: ' + chname)
                 users = chobj.users()
                 users.sort()
-                c.notice(nick, 'Users: ' + ', '.join(users))
+                self.reply(nick, 'Users: ' + ', '.join(users))
                 opers = chobj.opers()
                 opers.sort()
-                c.notice(nick, 'Opers: ' + ', '.join(opers))
+                self.reply(nick, 'Opers: ' + ', '.join(opers))
                 voiced = chobj.voiced()
                 voiced.sort()
-                c.notice(nick, 'Voiced: ' + ', '.join(voiced))
+                self.reply(nick, 'Voiced: ' + ', '.join(voiced))
+            if self.pipeline:
+                self.reply(nick, '--- Pipeline statistics ---')
+                self.reply(nick, 'Waiting chunks: evaluate %(evaluate)d '
+                           'write %(write)d flag %(flag)d' % self.pipeline.depths())
+            self.reply(nick, '--- Cache statistics ---')
+            self.reply(nick, 'Size: %(size)d Hits: %(hits)d Misses: %(misses)d '
+                       'Evictions: %(evictions)d' % _cache.stats())
+            self.reply(nick, 'Titles: Size: %(size)d Hits: %(hits)d Misses: %(misses)d '
+                       'Evictions: %(evictions)d' % _titles.stats())
+            self.reply(nick, '--- Ingest statistics ---')
+            for line in _metrics.summary():
+                self.reply(nick, line)
+            self.reply(nick, '--- Bugzilla statistics ---')
+            self.reply(nick, 'Sessions: %d' % _bugzilla.sessions)
+            for method, stats in sorted(_bugzilla.stats().iteritems()):
+                self.reply(nick, '%s: Calls: %d Errors: %d Retries: %d '
+                           'Avg: %.0fms Max: %.0fms' % (
+                               method, stats['calls'], stats['errors'],
+                               stats['retries'], stats['avg'] * 1000,
+                               stats['max'] * 1000))
         else:
-            c.notice(nick, 'Not understood: ' + cmd)
-
-    def say(self, msg):
-        c = self.connection
-        c.privmsg(self.channel, msg)
+            self.reply(nick, 'Not understood: ' + cmd)
+
+    def reply(self, nick, msg):
+        self.queue.reply(nick, msg)
+
+    def say(self, msg, kind=None, channel=None, date_=None):
+        self.queue.announce(channel or self.event_channels[0], msg, kind, date_)
+
+    def flush(self):
+        """Send the queued messages allowed by the flood control."""
+        if not self.connection.is_connected():
+            return
+        item = self.queue.pop()
+        while item:
+            method, target, msg, dates = item
+            getattr(self.connection, method)(target, msg)
+            # Time from the delivery of each mail to its announcement
+            now = datetime.now()
+            for date_ in dates:
+                if date_ >= self.started:
+                    _metrics.observe('announce_delay_seconds',
+                                     (now - date_).total_seconds())
+            item = self.queue.pop()
 
 
 class BugBotThread(threading.Thread):
@@ -125,29 +489,192 @@ class BugBotThread(threading.Thread):
         self.bot.start()
 
 
-def initdb(dbname):
-    """Initialize the database, removing old data."""
-    conn = sqlite3.connect(dbname)
-    c = conn.cursor()
-    c.execute('DROP TABLE IF EXISTS timeline')
+# Timeline columns with repeated values, interned in the compact format
+INTERNED = ('assigned_to', 'changed_fields', 'classification', 'component',
+            'foundby', 'keywords', 'priority', 'product', 'severity',
+            'status', 'target_milestone', 'type', 'version', 'who')
+
+TIMELINE = ('date', 'name') + INTERNED + ('body', 'bugid')
+
+
+class Connection(sqlite3.Connection):
+    """Writer connection.
+
+    Remember the ids of the strings interned by the compact timeline
+    format. They are forgotten when a transaction is rolled back.
+    `compact` and `fts` tell if the timeline uses the compact format,
+    and if it has a full-text index.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.strings = {}
+        self.compact = False
+        self.fts = False
+
+    def __exit__(self, type_, value, traceback):
+        if type_ is not None:
+            self.strings.clear()
+        return sqlite3.Connection.__exit__(self, type_, value, traceback)
+
+
+def inflate(body):
+    """Decompress a body stored in the compact timeline format."""
+    return zlib.decompress(str(body)) if body is not None else None
+
+
+def connect(dbname):
+    """Open the long-lived writer connection.
+
+    The database is switched to WAL mode, so the IRC thread can keep
+    reading the ranking (with its own connection) while the ingest
+    loop is inside a write transaction. Every commit is synced to disk:
+    the messages are flagged as seen right after it, so a commit lost
+    by a power failure would also lose the messages.
+
+    Arguments:
+        dbname -- database name
+
+    Returns:
+        Connection instance
+
+    """
+    conn = sqlite3.connect(dbname, cached_statements=64, factory=Connection)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=FULL')
+    conn.create_function('inflate', 1, inflate)
+    conn.compact = conn.execute("""SELECT 1 FROM sqlite_master
+                                   WHERE type='table' AND name='strings'""").fetchone() is not None
+    conn.fts = conn.execute("""SELECT 1 FROM sqlite_master
+                               WHERE type='table' AND name='timeline_fts'""").fetchone() is not None
+    return conn
+
+
+def create_timeline(c, compact=False):
+    """Create the timeline table, its indexes and the timeline_text view.
+
+    In the compact format the repeated values are ids in the strings
+    table, and the body is compressed with zlib. The timeline_text
+    view always shows the plain values, so readers do not need to
+    know the format.
+
+    Arguments:
+        c       -- database cursor
+        compact -- use the compact format
+
+    """
+    kind = 'INTEGER' if compact else 'TEXT'
     c.execute("""CREATE TABLE timeline (
                      date DATETIME,
                      name TEXT,
-                     assigned_to TEXT,
-                     changed_fields TEXT,
+                     %s,
+                     body %s,
+                     bugid INTEGER)""" % (',\n'.join('%s %s' % (f, kind) for f in INTERNED),
+                                          'BLOB' if compact else 'TEXT'))
+
+    if compact:
+        c.execute("""CREATE TABLE strings (
+                         id INTEGER PRIMARY KEY,
+                         value TEXT UNIQUE)""")
+        c.execute("""CREATE VIEW timeline_text AS
+                     SELECT t.rowid AS id, t.date, t.name, %s,
+                            inflate(t.body) AS body, t.bugid
+                     FROM timeline t %s""" % (
+            ', '.join('s%d.value AS %s' % (i, f) for i, f in enumerate(INTERNED)),
+            ' '.join('JOIN strings s%d ON s%d.id=t.%s' % (i, i, f)
+                     for i, f in enumerate(INTERNED))))
+    else:
+        c.execute('CREATE VIEW timeline_text AS SELECT rowid AS id, * FROM timeline')
+
+    c.execute('CREATE INDEX timeline_date_idx ON timeline (date)')
+    c.execute('CREATE INDEX timeline_bugid_idx ON timeline (bugid)')
+    c.execute('CREATE INDEX timeline_who_idx ON timeline (who)')
+
+
+def create_ranking_history(c):
+    """Create the ranking_history table, if it does not exist.
+
+    It has the ranking counters and points of each user for each
+    RANKING_INTERVAL, so the ranking at any time is the sum of the
+    intervals before it.
+
+    Arguments:
+        c -- database cursor
+
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS ranking_history (
+                     interval INTEGER,
+                     name TEXT,
+                     %s,
+                     event TEXT NOT NULL DEFAULT '%s',
+                     PRIMARY KEY (event, interval, name))""" % (',\n'.join(
+        '%s INTEGER NOT NULL DEFAULT 0' % column for column in RANKING[1:]), EVENT))
+    c.execute("""CREATE INDEX IF NOT EXISTS ranking_history_name_idx
+                 ON ranking_history (event, name, interval)""")
+
+
+def create_events(c):
+    """Create the events table, if it does not exist.
+
+    Every event has its own time window, points table (JSON, TABLE if
+    NULL), classification and product filters (NULL to accept any), IRC
+    channel and HTML file. The ranking tables keep the rows of all the
+    events, with the name of the event in their `event` column.
+
+    Arguments:
+        c -- database cursor
+
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS events (
+                     name TEXT PRIMARY KEY,
+                     start TIMESTAMP,
+                     stop TIMESTAMP,
+                     points TEXT,
                      classification TEXT,
-                     component TEXT,
-                     foundby TEXT,
-                     keywords TEXT,
-                     priority TEXT,
                      product TEXT,
-                     severity TEXT,
-                     status TEXT,
-                     target_milestone TEXT,
-                     type TEXT,
-                     version TEXT,
-                     who TEXT,
-                     body TEXT)""")
+                     channel TEXT,
+                     html TEXT)""")
+
+
+def create_search_index(c):
+    """Create and fill the full-text index of the timeline, if missing.
+
+    timeline_fts is an FTS5 table over the subject (`name`) and the
+    body of each message. Its content is read from the timeline_text
+    view, so the text is not stored twice, and store() adds the new
+    rows. Nothing is done if SQLite is built without FTS5.
+
+    Arguments:
+        c -- database cursor
+
+    Returns:
+        True if the index exists
+
+    """
+    if c.execute("""SELECT 1 FROM sqlite_master
+                    WHERE type='table' AND name='timeline_fts'""").fetchone():
+        return True
+    try:
+        c.execute("""CREATE VIRTUAL TABLE timeline_fts USING fts5 (
+                         name, body, content='timeline_text', content_rowid='id')""")
+    except sqlite3.OperationalError, e:
+        print 'No full-text search (%s)' % e
+        return False
+    c.execute("INSERT INTO timeline_fts (timeline_fts) VALUES ('rebuild')")
+    return True
+
+
+def initdb(dbname, compact=False):
+    """Initialize the database, removing old data (but not the events)."""
+    conn = connect(dbname)
+    c = conn.cursor()
+    c.execute('DROP TABLE IF EXISTS timeline_fts')
+    c.execute('DROP VIEW IF EXISTS timeline_text')
+    c.execute('DROP TABLE IF EXISTS timeline')
+    c.execute('DROP TABLE IF EXISTS strings')
+    create_timeline(c, compact)
+    create_search_index(c)
 
     c.execute('DROP TABLE IF EXISTS ranking')
     c.execute("""CREATE TABLE ranking (
@@ -161,21 +688,161 @@ def initdb(dbname):
                      bronze_scr INTEGER,
                      other_scr INTEGER,
                      suspicious INTEGER,
-                     other INTEGER)""")
+                     other INTEGER,
+                     points INTEGER NOT NULL DEFAULT 0,
+                     event TEXT NOT NULL DEFAULT '%s')""" % EVENT)
 
     c.execute('DROP INDEX IF EXISTS ranking_name_idx')
-    c.execute('CREATE UNIQUE INDEX ranking_name_idx ON ranking (name)')
+    c.execute('CREATE UNIQUE INDEX ranking_name_idx ON ranking (event, name)')
+    c.execute('DROP INDEX IF EXISTS ranking_points_idx')
+    c.execute('CREATE INDEX ranking_points_idx ON ranking (event, points)')
+
+    c.execute('DROP TABLE IF EXISTS state')
+    c.execute("""CREATE TABLE state (
+                     key TEXT PRIMARY KEY,
+                     value TEXT)""")
+
+    c.execute('DROP TABLE IF EXISTS ranking_history')
+    create_ranking_history(c)
 
     c.execute('DROP TABLE IF EXISTS ranking_log')
     c.execute("""CREATE TABLE ranking_log (
                      name TEXT,
                      bugid TEXT,
-                     status TEXT)""")
+                     status TEXT,
+                     event TEXT NOT NULL DEFAULT '%s')""" % EVENT)
+
+    create_events(c)
+
+    c.execute('DROP TABLE IF EXISTS messages')
+    c.execute("""CREATE TABLE messages (
+                     message_id TEXT PRIMARY KEY)""")
 
     conn.commit()
     conn.close()
 
 
+def upgradedb(conn):
+    """Bring an existing database up to date with the current schema.
+
+    Also recompute the stored points, so a change in the points table
+    of an event is applied to its existing ranking.
+
+    Arguments:
+        conn -- writer connection (see connect())
+
+    """
+    with conn:
+        columns = [r[1] for r in conn.execute('PRAGMA table_info(ranking)')]
+        if 'points' not in columns:
+            conn.execute("""ALTER TABLE ranking
+                            ADD COLUMN points INTEGER NOT NULL DEFAULT 0""")
+        if 'event' not in columns:
+            # Rankings from before the events belong to the default one
+            conn.execute("""ALTER TABLE ranking
+                            ADD COLUMN event TEXT NOT NULL DEFAULT '%s'""" % EVENT)
+            conn.execute("""ALTER TABLE ranking_log
+                            ADD COLUMN event TEXT NOT NULL DEFAULT '%s'""" % EVENT)
+            conn.execute('DROP INDEX IF EXISTS ranking_name_idx')
+            conn.execute('DROP INDEX IF EXISTS ranking_points_idx')
+            conn.execute('CREATE UNIQUE INDEX ranking_name_idx ON ranking (event, name)')
+        conn.execute("""CREATE INDEX IF NOT EXISTS ranking_points_idx
+                        ON ranking (event, points)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS state (
+                            key TEXT PRIMARY KEY,
+                            value TEXT)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                            message_id TEXT PRIMARY KEY)""")
+        create_events(conn.cursor())
+
+        # The primary key of ranking_history gets the event: copy it
+        # into a new table
+        columns = [r[1] for r in conn.execute('PRAGMA table_info(ranking_history)')]
+        if columns and 'event' not in columns:
+            conn.execute('ALTER TABLE ranking_history RENAME TO ranking_history_old')
+            conn.execute('DROP INDEX ranking_history_name_idx')
+            create_ranking_history(conn.cursor())
+            conn.execute('INSERT INTO ranking_history SELECT *, ? FROM ranking_history_old',
+                         (EVENT,))
+            conn.execute('DROP TABLE ranking_history_old')
+        else:
+            create_ranking_history(conn.cursor())
+
+        columns = [r[1] for r in conn.execute('PRAGMA table_info(timeline)')]
+        if 'bugid' not in columns:
+            conn.execute('ALTER TABLE timeline ADD COLUMN bugid INTEGER')
+            rows = conn.execute('SELECT rowid, name FROM timeline').fetchall()
+            conn.executemany('UPDATE timeline SET bugid=? WHERE rowid=?',
+                             [(int(m.group(1)), rowid) for rowid, name in rows
+                              for m in [_BUGID.search(name or '')] if m])
+        conn.execute('CREATE INDEX IF NOT EXISTS timeline_date_idx ON timeline (date)')
+        conn.execute('CREATE INDEX IF NOT EXISTS timeline_bugid_idx ON timeline (bugid)')
+        conn.execute('CREATE INDEX IF NOT EXISTS timeline_who_idx ON timeline (who)')
+        conn.execute("""CREATE VIEW IF NOT EXISTS timeline_text AS
+                        SELECT rowid AS id, * FROM timeline""")
+        conn.fts = create_search_index(conn.cursor())
+
+        # The history too, so the ranking at any time uses the same
+        # points table as the current one
+        for event in load_events(conn):
+            for table in ('ranking', 'ranking_history'):
+                conn.execute("""UPDATE %s
+                                SET points=gold_fix*? + silver_fix*? + bronze_fix*? +
+                                           other_fix*? + gold_scr*? + silver_scr*? +
+                                           bronze_scr*? + other_scr*?
+                                WHERE event=?""" % table,
+                             (event.table['FIX GOLD'],
+                              event.table['FIX SILVER'],
+                              event.table['FIX BRONZE'],
+                              event.table['FIX OTHER'],
+                              event.table['SCR GOLD'],
+                              event.table['SCR SILVER'],
+                              event.table['SCR BRONZE'],
+                              event.table['SCR OTHER'],
+                              event.name))
+
+
+def compact_timeline(conn):
+    """Convert the timeline into the compact format (see create_timeline()).
+
+    Arguments:
+        conn -- writer connection (see connect())
+
+    """
+    if conn.compact:
+        return
+
+    with conn:
+        conn.execute('DROP VIEW timeline_text')
+        for index in ('timeline_date_idx', 'timeline_bugid_idx', 'timeline_who_idx'):
+            conn.execute('DROP INDEX IF EXISTS %s' % index)
+        conn.execute('ALTER TABLE timeline RENAME TO timeline_plain')
+        create_timeline(conn.cursor(), compact=True)
+        conn.compact = True
+
+        c = conn.execute('SELECT %s FROM timeline_plain ORDER BY rowid' % ', '.join(TIMELINE))
+        rows = c.fetchmany(1000)
+        while rows:
+            conn.executemany(_INSERT_TIMELINE, [compact_row(conn, row) for row in rows])
+            rows = c.fetchmany(1000)
+        conn.execute('DROP TABLE timeline_plain')
+        # The rowids may have changed
+        if conn.fts:
+            conn.execute("INSERT INTO timeline_fts (timeline_fts) VALUES ('rebuild')")
+    conn.execute('VACUUM')
+
+
+def get_state(conn, key, default=None):
+    """Read a value from the state table."""
+    row = conn.execute('SELECT value FROM state WHERE key=?', (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_state(conn, key, value):
+    """Write a value into the state table. The caller owns the transaction."""
+    conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+
 def login(host, user, passwd, ssl):
     """Connect to an IMAP server.
 
@@ -189,11 +856,92 @@ def login(host, user, passwd, ssl):
         IMAPClient instance
 
     """
-    server = IMAPClient(host, use_uid=False, ssl=ssl)
+    server = IMAPClient(host, use_uid=True, ssl=ssl)
     server.login(user, passwd)
     return server
 
 
+# X-Bugzilla-* headers kept in a BugAction, and the attribute for each one
+HEADERS = {
+    'Assigned-To':       'assigned_to',
+    'Changed-Fields':    'changed_fields',
+    'Classification':    'classification',
+    'Component':         'component',
+    'Foundby':           'foundby',
+    'Keywords':          'keywords',
+    'Priority':          'priority',
+    'Product':           'product',
+    'Severity':          'severity',
+    'Status':            'status',
+    'Target-Milestone':  'target_milestone',
+    'Type':              'type',
+    'Version':           'version',
+    'Who':               'who',
+}
+
+# Headers needed to evaluate a bug action
+REQUIRED_HEADERS = ('Type', 'Who', 'Status')
+
+_XBUGZILLA = re.compile(r'\nX-Bugzilla-([\w-]+):[ \t]*([^\r\n]*)')
+# Without re.I and ^, so the regex engine can skip to each newline
+_MESSAGE_ID = re.compile(r'\nMessage-I[Dd]:[ \t]*([^\r\n]*)')
+_SUBJECT = re.compile(r'(?:^|\n)Subject:[ \t]*([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)', re.I)
+_BUGID = re.compile(r'\[Bug (\d+)\]')
+
+
+class BugAction(object):
+    """A bug action, parsed from a Bugzilla notification.
+
+    The attributes follow the columns of the timeline table, plus the
+    Message-ID (None if missing). Missing optional X-Bugzilla-* headers
+    are empty strings. The body is kept
+    as a reference to the fetched buffer plus an optional slice, and
+    it is only copied out when it is read.
+
+    """
+
+    __slots__ = ('date', 'name', 'bugid', 'message_id') + \
+                tuple(sorted(HEADERS.values())) + ('_raw', '_start', '_end')
+
+    def __init__(self, date_, name, headers, body=None, start=0, end=None):
+        self.date = date_
+        self.name = name
+        match = _BUGID.search(name or '')
+        if not match:
+            raise ValueError('Not a bug notification: %s' % name)
+        self.bugid = match.group(1)
+
+        # Headers never start with an X-Bugzilla or a Message-ID line
+        # (the server adds Return-Path or Received first), so all of
+        # them are found after a newline
+        found = dict(_XBUGZILLA.findall(headers))
+        for header in REQUIRED_HEADERS:
+            if header not in found:
+                raise ValueError('Missing X-Bugzilla-%s header in %s' % (header, name))
+        for header, attr in HEADERS.iteritems():
+            setattr(self, attr, found.get(header, '').rstrip())
+
+        match = _MESSAGE_ID.search(headers)
+        self.message_id = match.group(1).strip() if match else None
+
+        self.set_body(body, start, end)
+
+    def set_body(self, raw, start=0, end=None):
+        """Reference the body as raw[start:end], without copying it."""
+        self._raw = raw
+        self._start = start
+        self._end = end
+
+    @property
+    def body(self):
+        if self._raw is None:
+            return None
+        if self._start == 0 and self._end is None and isinstance(self._raw, str):
+            return self._raw
+        end = self._end if self._end is not None else len(self._raw)
+        return str(buffer(self._raw, self._start, end - self._start))
+
+
 def process_msg(msg):
     """Convert a single message into a bug action.
 
@@ -201,292 +949,1426 @@ def process_msg(msg):
         msg -- message fetched from the server
 
     Returns:
-        A dictionary object that represent a bug action
-
-    """
-    date_ = msg['INTERNALDATE']
-    name = msg['ENVELOPE'][1]
-
-    headers = msg['BODY[HEADER]']
-    xbug = dict()
-    for line in headers.split('\r\n'):
-        if line.startswith('X-Bugzilla'):
-            i = line.index(':')
-            k, v = line[:i], line[i+1:]
-            xbug[k] = v.strip()
-
-    body = msg['BODY[TEXT]']
-
-    return {
-        'date': date_,
-        'name': name,
-        'assigned-to': xbug['X-Bugzilla-Assigned-To'],
-        'changed-fields': xbug['X-Bugzilla-Changed-Fields'],
-        'classification': xbug['X-Bugzilla-Classification'],
-        'component': xbug['X-Bugzilla-Component'],
-        'foundby': xbug['X-Bugzilla-Foundby'],
-        'keywords': xbug['X-Bugzilla-Keywords'],
-        'priority': xbug['X-Bugzilla-Priority'],
-        'product': xbug['X-Bugzilla-Product'],
-        'severity': xbug['X-Bugzilla-Severity'],
-        'status': xbug['X-Bugzilla-Status'],
-        'target-milestone': xbug['X-Bugzilla-Target-Milestone'],
-        'type': xbug['X-Bugzilla-Type'],
-        'version': xbug['X-Bugzilla-Version'],
-        'who': xbug['X-Bugzilla-Who'],
-        'body': body,
-    }
+        A BugAction instance
 
+    Raises:
+        ValueError if the message is not a complete bug notification
 
-def store(dbname, bug):
-    """Store a single bug action.
+    """
+    # The body is only fetched when the classification needs it
+    return BugAction(msg['INTERNALDATE'], msg['ENVELOPE'][1],
+                     msg['BODY[HEADER]'], msg.get('BODY[TEXT]'))
+
+
+def parse_mail(raw, date_=None, start=0, end=None):
+    """Convert a raw RFC822 mail into a bug action.
+
+    Only the headers are copied. The body is referenced as a slice of
+    `raw` (see BugAction), and copied when it is read.
 
     Arguments:
-        dbname -- database name
-        bug    -- a dict that store a bug action
+        raw   -- the mail, headers and body
+        date_ -- delivery date (default now)
+        start -- offset of the mail in raw
+        end   -- end of the mail in raw (default the end of raw)
+
+    Returns:
+        A BugAction instance
+
+    Raises:
+        ValueError if the mail is not a complete bug notification
 
     """
-    conn = sqlite3.connect(dbname)
-    c = conn.cursor()
-    c.execute("""INSERT INTO timeline
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-              (bug['date'],
-               bug['name'],
-               bug['assigned-to'],
-               bug['changed-fields'],
-               bug['classification'],
-               bug['component'],
-               bug['foundby'],
-               bug['keywords'],
-               bug['priority'],
-               bug['product'],
-               bug['severity'],
-               bug['status'],
-               bug['target-milestone'],
-               bug['type'],
-               bug['version'],
-               bug['who'],
-               bug['body']))
-    conn.commit()
-    conn.close()
+    if end is None:
+        end = len(raw)
+    # The headers end at the first empty line, with either line ending
+    ends = [(i, len(sep)) for sep in ('\r\n\r\n', '\n\n')
+            for i in [raw.find(sep, start, end)] if i != -1]
+    if ends:
+        i, sep = min(ends)
+        body = i + sep
+    else:
+        body = end
+    header = raw[start:body]
 
+    match = _SUBJECT.search(header)
+    subject = re.sub(r'\r?\n[ \t]+', ' ', match.group(1)) if match else None
+    return BugAction(date_ or datetime.now(), subject, header, raw, body, end)
 
-_cache = {}
-def get_bug_evaluation(bugid):
-    """Get bug evaluation. Use an external cache for external invalidation"""
 
-    if bugid in _cache:
-        return _cache[bugid]
+_INSERT_TIMELINE = 'INSERT INTO timeline (%s) VALUES (%s)' % (
+    ', '.join(TIMELINE), ', '.join('?' * len(TIMELINE)))
+_INSERT_SEARCH = 'INSERT INTO timeline_fts (rowid, name, body) VALUES (?, ?, ?)'
+
+
+def intern_string(conn, value):
+    """Return the id of a value in the strings table, adding it if needed."""
+    try:
+        return conn.strings[value]
+    except KeyError:
+        row = conn.execute('SELECT id FROM strings WHERE value IS ?', (value,)).fetchone()
+        if row:
+            id_ = row[0]
+        else:
+            id_ = conn.execute('INSERT INTO strings (value) VALUES (?)', (value,)).lastrowid
+        conn.strings[value] = id_
+        return id_
+
+
+def compress(body):
+    """Compress a body for the compact timeline format."""
+    if body is None:
+        return None
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    return sqlite3.Binary(zlib.compress(body))
+
+
+def compact_row(conn, row):
+    """Convert a timeline row (in TIMELINE order) into the compact format."""
+    return (row[:2] +
+            tuple(intern_string(conn, value) for value in row[2:-2]) +
+            (compress(row[-2]), row[-1]))
+
+
+def store(conn, bug):
+    """Store a single bug action.
+
+    The caller owns the transaction.
+
+    Arguments:
+        conn -- writer connection (see connect())
+        bug  -- BugAction instance
+
+    """
+    row = ((bug.date, bug.name) +
+           tuple(getattr(bug, f) for f in INTERNED) +
+           (bug.body, int(bug.bugid)))
+    if conn.compact:
+        row = compact_row(conn, row)
+    rowid = conn.execute(_INSERT_TIMELINE, row).lastrowid
+    if conn.fts:
+        conn.execute(_INSERT_SEARCH, (rowid, bug.name, bug.body))
+
+
+# Maximum number of ids sent in a single get_bugs() call
+BZ_CHUNK = 100
 
-    bz = suse.bugzilla.Bugzilla(None, None, base=BZ_HOST)
-    bz.browser.add_password(BZ_HOST, BZ_USERNAME, BZ_PASSWORD)
-    bug = bz.get_bugs(ids=(bugid,))[0]
 
+def bug_evaluation(bug):
+    """Get the evaluation (GOLD, SILVER, BRONZE or OTHER) of a Bugzilla bug."""
     evaluation = 'OTHER'
     if hasattr(bug, 'status_whiteboard'):
         for evaluation in ('GOLD', 'SILVER', 'BRONZE', 'OTHER'):
             if evaluation in bug.status_whiteboard:
                 break
+    return evaluation
+
+
+class EvaluationCache(object):
+    """Bug evaluations, in a bounded LRU in front of a SQLite table.
 
-    _cache[bugid] = evaluation
+    Every entry has its own expiration time. The persistent table lives
+    in the bugmonitor database, so a restart does not need to query
+    Bugzilla again for every active bug. Changes are kept in memory
+    until flush() is called, so the cache never writes while the ingest
+    loop holds the database write lock.
+
+    """
+
+    def __init__(self, dbname=None, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lru = collections.OrderedDict()
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if dbname:
+            self._conn = sqlite3.connect(dbname, check_same_thread=False)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS evaluation_cache (
+                                      bugid TEXT PRIMARY KEY,
+                                      evaluation TEXT,
+                                      expires REAL)""")
+            self._conn.commit()
+
+    def __len__(self):
+        return len(self._lru)
+
+    def _remember(self, bugid, entry):
+        self._lru[bugid] = entry
+        if len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, bugid):
+        now = time.time()
+        entry = self._lru.pop(bugid, None)
+        if not entry and bugid in self._dirty:
+            entry = self._dirty[bugid]
+        elif not entry and self._conn:
+            entry = self._conn.execute("""SELECT evaluation, expires
+                                          FROM evaluation_cache
+                                          WHERE bugid=?""",
+                                       (bugid,)).fetchone()
+        if entry and entry[1] > now:
+            self._remember(bugid, entry)
+            return entry[0]
+        return None
+
+    def get(self, bugid):
+        """Return the cached evaluation of a bug, or None if unknown.
+
+        The lookup is counted as a hit or a miss.
+
+        """
+        with self._lock:
+            evaluation = self._lookup(bugid)
+            if evaluation is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return evaluation
+
+    def peek(self, bugid):
+        """Like get(), without counting the lookup."""
+        with self._lock:
+            return self._lookup(bugid)
+
+    def put(self, bugid, evaluation, ttl=None):
+        """Store the evaluation of a bug for ttl seconds."""
+        entry = (evaluation, time.time() + (ttl or self.ttl))
+        with self._lock:
+            self._lru.pop(bugid, None)
+            self._remember(bugid, entry)
+            self._dirty[bugid] = entry
+
+    def invalidate(self, bugid):
+        """Forget the evaluation of a bug."""
+        with self._lock:
+            self._lru.pop(bugid, None)
+            self._dirty[bugid] = None
+
+    def flush(self):
+        """Write the pending changes into the persistent table."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            if not self._conn or not dirty:
+                return
+            with self._conn:
+                self._conn.executemany('DELETE FROM evaluation_cache WHERE bugid=?',
+                                       [(k,) for k, v in dirty.iteritems() if not v])
+                self._conn.executemany('INSERT OR REPLACE INTO evaluation_cache VALUES (?, ?, ?)',
+                                       [(k,) + v for k, v in dirty.iteritems() if v])
+
+    def stats(self):
+        """Return the hit, miss and eviction counters."""
+        return {
+            'size': len(self._lru),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+_cache = EvaluationCache()
+# Titles of the bugs, for the bnc#NNN mentions (in memory only)
+_titles = EvaluationCache()
+_bugzilla = bzclient.Client(BZ_HOST, BZ_USERNAME, BZ_PASSWORD,
+                            size=BZ_WORKERS, chunk=BZ_CHUNK)
+def cache_bug(bug):
+    """Cache the evaluation and the title of a bug fetched from Bugzilla.
+
+    The same get_bugs() call fills both caches, but the titles have
+    their own LRU, so they never evict an evaluation.
+
+    Returns:
+        The evaluation of the bug
 
+    """
+    bugid = str(bug.bug_id)
+    evaluation = bug_evaluation(bug)
+    _cache.put(bugid, evaluation)
+    if getattr(bug, 'summary', None):
+        _titles.put(bugid, bug.summary)
     return evaluation
 
 
-def is_fix(bug):
-    return (bug['type'] == 'changed' and
-            'Status' in bug['changed-fields'] and
-            'Resolution' in bug['changed-fields'] and
-            bug['status'] in ('CLOSED', 'RESOLVED')) 
+def get_bug_evaluation(bugid):
+    """Get bug evaluation. Use an external cache for external invalidation
+
+    The lookup is not counted in the cache statistics: it was already
+    counted by prefetch_bug_evaluations(), which runs first. A bug that
+    Bugzilla does not return is evaluated as OTHER for MISSING_TTL
+    seconds, so one private or deleted bug never blocks the ingest.
+
+    """
 
+    evaluation = _cache.peek(bugid)
+    if evaluation:
+        return evaluation
 
-def is_scr(bug):
-    return (bug['type'] == 'changed' and
-            bug['status'] not in ('CLOSED', 'RESOLVED') and
-            '--- Comment #' in bug['body'] and
-            'This is an autogenerated message for OBS integration' not in bug['body'])
+    _metrics.count('bugzilla_single_lookups')
+    bugs = _bugzilla.get_bugs((bugid,))
+    if not bugs:
+        print 'Bug %s not returned by Bugzilla, evaluated as OTHER' % bugid
+        _metrics.count('bugzilla_missing_bugs')
+        _cache.put(bugid, 'OTHER', ttl=MISSING_TTL)
+        return 'OTHER'
 
+    return cache_bug(bugs[0])
 
-def is_new(bug):
-    return bug['type'] == 'new'
 
+def prefetch_bug_evaluations(bugids):
+    """Fill the evaluation cache for several bugs at once.
 
-def is_reopen(bug):
-    return (bug['type'] == 'changed' and
-            'Status' in bug['changed-fields'] and
-            bug['status'] not in ('CLOSED', 'RESOLVED') and
-            re.search(r'Status|\s*CLOSED\s*|', bug['body']))
+    The cache misses are resolved with chunked get_bugs() calls. Ids
+    that a bulk call fails to return are left out of the cache, so
+    get_bug_evaluation() will fetch them one by one later. This is
+    the lookup counted in the cache hits and misses, once for each id.
 
+    Arguments:
+        bugids -- iterable of bug numbers (as strings)
 
-def is_auto(bug):
-    return ('--- Comment #' in bug['body'] and
-            'This is an autogenerated message for OBS integration' in bug['body'])
+    """
+    missing = sorted(set(bugid for bugid in bugids if not _cache.get(bugid)))
+    if not missing:
+        return
+
+    for i in range(0, len(missing), BZ_CHUNK):
+        chunk = missing[i:i+BZ_CHUNK]
+        try:
+            bugs = _bugzilla.get_bugs(chunk)
+        except Exception, e:
+            print 'Error prefetching %d bugs: %s' % (len(chunk), e)
+            continue
+        for bug in bugs:
+            cache_bug(bug)
 
 
-def is_suspicious(bug):
-    return (bug['type'] == 'changed' and
-            'Whiteboard' in bug['changed-fields'])
+_MENTION = re.compile(r'\bbnc#(\d+)', re.I)
 
 
-def evaluate(dbname, bug, bot):
-    """Evaluate a bug action. Update the ranking table.
+class TitleLookup(object):
+    """Get bug titles for the bnc#NNN mentions, without blocking.
+
+    Cached titles are answered at once. The others are fetched by a
+    background thread, and `callback(target, bugid, title)` is called
+    from that thread. A bug already being fetched is not asked again:
+    its target is added to the waiting list. All the bugs waiting when
+    the thread wakes up are fetched with a single get_bugs() call.
+
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._waiting = {}
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._worker)
+        thread.daemon = True
+        thread.start()
+
+    def request(self, bugids, target):
+        """Ask for the titles of several bugs, to be sent to `target`."""
+        new = []
+        with self._lock:
+            for bugid in bugids:
+                title = _titles.get(bugid)
+                if title:
+                    self.callback(target, bugid, title)
+                elif bugid in self._waiting:
+                    _metrics.count('title_coalesced')
+                    if target not in self._waiting[bugid]:
+                        self._waiting[bugid].append(target)
+                else:
+                    self._waiting[bugid] = [target]
+                    new.append(bugid)
+        if new:
+            self._queue.put(new)
+
+    def _worker(self):
+        while True:
+            bugids = self._queue.get()
+            while not self._queue.empty():
+                bugids.extend(self._queue.get())
+
+            _metrics.count('title_lookups')
+            try:
+                bugs = _bugzilla.get_bugs(bugids)
+            except Exception, e:
+                print 'Error getting the title of %d bugs: %s' % (len(bugids), e)
+                bugs = []
+            titles = {}
+            for bug in bugs:
+                cache_bug(bug)
+                titles[str(bug.bug_id)] = getattr(bug, 'summary', None)
+
+            for bugid in bugids:
+                with self._lock:
+                    targets = self._waiting.pop(bugid, [])
+                if titles.get(bugid):
+                    for target in targets:
+                        self.callback(target, bugid, titles[bugid])
+
+
+# Ranking column updated for each bucket
+COLUMNS = {
+    'FIX GOLD':   'gold_fix',
+    'FIX SILVER': 'silver_fix',
+    'FIX BRONZE': 'bronze_fix',
+    'FIX OTHER':  'other_fix',
+    'SCR GOLD':   'gold_scr',
+    'SCR SILVER': 'silver_scr',
+    'SCR BRONZE': 'bronze_scr',
+    'SCR OTHER':  'other_scr',
+    'SUSPICIOUS': 'suspicious',
+    'OTHER':      'other',
+}
+
+# Markers searched in the body of a bug action
+MARKERS = {
+    'comment': r'--- Comment #',
+    'obs':     r'This is an autogenerated message for OBS integration',
+    'reopen':  r'Status\|\s*(?:CLOSED|RESOLVED)\s*\|',
+}
+
+# Classification rules, see Classifier
+RULES = [
+    {'action': 'FIX', 'bucket': 'FIX %(evaluation)s',
+     'type': ['changed'],
+     'changed-fields': ['Status', 'Resolution'],
+     'status': ['CLOSED', 'RESOLVED']},
+    {'action': 'SCR/NEW', 'bucket': 'SCR %(evaluation)s',
+     'type': ['changed'],
+     'not-status': ['CLOSED', 'RESOLVED'],
+     'body': ['comment'],
+     'not-body': ['obs']},
+    {'action': 'SCR/NEW', 'bucket': 'SCR %(evaluation)s',
+     'type': ['new'],
+     'not-body': ['obs']},
+    {'action': 'SUSPICIOUS/REOPEN', 'bucket': 'SUSPICIOUS',
+     'type': ['changed'],
+     'changed-fields': ['Whiteboard']},
+    {'action': 'SUSPICIOUS/REOPEN', 'bucket': 'SUSPICIOUS',
+     'type': ['changed'],
+     'changed-fields': ['Status'],
+     'not-status': ['CLOSED', 'RESOLVED'],
+     'body': ['reopen']},
+]
+
+
+class Classifier(object):
+    """Classify bug actions with a table of rules.
+
+    The rules are checked in order, and the first one that matches
+    gives the action and the ranking bucket. The bucket can refer to
+    the evaluation of the bug as `%(evaluation)s`. A bug action that
+    matches no rule is classified as OTHER. A rule matches when all
+    its conditions are true:
+
+        type, status   -- the header value is in the list
+        not-status     -- the header value is not in the list
+        changed-fields -- all the names are in the header
+        body           -- all the markers are found in the body
+        not-body       -- none of the markers is found in the body
+
+    The markers are compiled once, and a body is only read when a rule
+    needs it. A marker is a regular expression, unless it has no
+    special characters.
+
+    The headers are only checked once for each combination of type,
+    status and changed fields: the rules they leave are kept, up to the
+    first one that does not read the body (it always matches).
+
+    """
+
+    # Conditions of a rule
+    KEYS = ('action', 'bucket', 'type', 'status', 'not-status',
+            'changed-fields', 'body', 'not-body')
+
+    # Maximum number of header combinations kept
+    CANDIDATES = 4096
+
+    def __init__(self, markers=MARKERS, rules=RULES):
+        self._markers = dict((name, self._compile_marker(pattern))
+                             for name, pattern in markers.iteritems())
+        self._rules = [self._compile(rule, markers) for rule in rules]
+        self._candidates = {}
+
+    @staticmethod
+    def _compile_marker(pattern):
+        """Return a (marker, plain) tuple: plain strings are faster to
+        find without the regex engine."""
+        if not any(c in pattern for c in '.^$*+?{}[]\\|()'):
+            return pattern, True
+        return re.compile(pattern), False
+
+    def _compile(self, rule, markers):
+        def field(key):
+            return frozenset(rule[key]) if key in rule else None
+
+        for key in rule:
+            if key not in self.KEYS:
+                raise ValueError('Unknown condition %s in rule %s' % (key, rule.get('action')))
+        for name in rule.get('body', []) + rule.get('not-body', []):
+            if name not in markers:
+                raise ValueError('Unknown marker %s' % name)
+        if rule['bucket'] % {'evaluation': 'OTHER'} not in COLUMNS:
+            raise ValueError('Unknown bucket %s' % rule['bucket'])
+
+        headers = (field('type'),
+                   field('status'),
+                   field('not-status'),
+                   tuple(rule.get('changed-fields', ())))
+        # Each marker with the result the rule expects from it
+        body = tuple(self._markers[name] + (True,) for name in rule.get('body', ())) + \
+               tuple(self._markers[name] + (False,) for name in rule.get('not-body', ()))
+        buckets = dict((evaluation, rule['bucket'] % {'evaluation': evaluation})
+                       for evaluation in ('GOLD', 'SILVER', 'BRONZE', 'OTHER'))
+        return headers, (rule['action'], rule['bucket'], buckets, body)
+
+    def _match(self, key):
+        """Return the rules left by a (type, status, changed fields) key."""
+        candidates = self._candidates.get(key)
+        if candidates is None:
+            type_, status, changed = key
+            candidates = []
+            for (types, in_status, not_status, fields), result in self._rules:
+                if types is not None and type_ not in types:
+                    continue
+                if in_status is not None and status not in in_status:
+                    continue
+                if not_status is not None and status in not_status:
+                    continue
+                if not all(field in changed for field in fields):
+                    continue
+                candidates.append(result)
+                if not result[3]:
+                    break
+            candidates = tuple(candidates)
+            if len(self._candidates) >= self.CANDIDATES:
+                self._candidates.clear()
+            self._candidates[key] = candidates
+        return candidates
+
+    def needs_body(self, bug):
+        """Tell if the classification of a bug action reads its body."""
+        candidates = self._match((bug.type, bug.status, bug.changed_fields))
+        return bool(candidates and candidates[0][3])
+
+    def classify(self, bug, evaluation):
+        """Classify a bug action.
+
+        Arguments:
+            bug        -- BugAction instance
+            evaluation -- GOLD, SILVER, BRONZE or OTHER
+
+        Returns:
+            A (action, bucket) tuple
+
+        """
+        key = (bug.type, bug.status, bug.changed_fields)
+        candidates = self._candidates.get(key)
+        if candidates is None:
+            candidates = self._match(key)
+
+        text = None
+        for action, bucket, buckets, body in candidates:
+            for marker, plain, expected in body:
+                if text is None:
+                    text = bug.body or ''
+                if (marker in text if plain else marker.search(text) is not None) != expected:
+                    break
+            else:
+                return action, (buckets.get(evaluation) or
+                                bucket % {'evaluation': evaluation})
+        return 'OTHER', 'OTHER'
+
+
+def load_rules(filename):
+    """Build a Classifier from a JSON file with `markers` and `rules`."""
+    with open(filename) as f:
+        config = json.load(f)
+    return Classifier(config.get('markers', MARKERS), config.get('rules', RULES))
+
+
+_rules = Classifier()
+
+
+class Event(object):
+    """An event, with its own ranking.
+
+    A bug action counts for an event when its date is inside the
+    START/STOP window, and it passes the classification filter (the
+    same classification) and the product filter (a product that starts
+    with it, so 'SUSE Linux Enterprise' matches all the SLE products).
+    An empty filter accepts any bug. `table` changes some points of
+    TABLE for the event.
+
+    """
+
+    def __init__(self, name, start, stop, table=None, classification=None,
+                 product=None, channel=None, html=None):
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.table = dict(TABLE)
+        for bucket, points in (table or {}).iteritems():
+            if bucket not in COLUMNS:
+                raise ValueError('Unknown bucket %s in event %s' % (bucket, name))
+            self.table[bucket] = points
+        self.classification = classification
+        self.product = product
+        self.channel = channel
+        self.html = html
+
+    def accepts(self, bug):
+        """Tell if a bug action passes the filters of the event."""
+        if self.classification and (bug.classification or '') != self.classification:
+            return False
+        if self.product and not (bug.product or '').startswith(self.product):
+            return False
+        return True
+
+    def matches(self, bug):
+        """Tell if a bug action counts for the event."""
+        return self.start <= bug.date < self.stop and self.accepts(bug)
+
+
+_events = [Event(EVENT, START, STOP, channel=IRC_CHANNEL, html=HTML)]
+
+
+def matching_events(bug):
+    """Return the events a bug action counts for."""
+    return [event for event in _events if event.matches(bug)]
+
+
+def get_event(name):
+    """Return the event with this name, or None."""
+    for event in _events:
+        if event.name == name:
+            return event
+    return None
+
+
+def read_events(filename):
+    """Read the events of a JSON file.
+
+    The file has a list of objects with the `name`, `start` and `stop`
+    of each event (see parse_time()), and optionally its `points`
+    (bucket to points), `classification`, `product`, `channel` and
+    `html`.
+
+    Returns:
+        List of Event instances
+
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    events = []
+    for item in config:
+        start = parse_time(item.get('start', ''))
+        stop = parse_time(item.get('stop', ''))
+        if not item.get('name') or not start or not stop or start >= stop:
+            raise ValueError('Event without a name or a valid time window: %s' % item)
+        if any(event.name == item['name'] for event in events):
+            raise ValueError('Duplicated event %s' % item['name'])
+        events.append(Event(item['name'], start, stop, item.get('points'),
+                            item.get('classification'), item.get('product'),
+                            item.get('channel'), item.get('html')))
+    return events
+
+
+def set_events(conn, events):
+    """Replace the events stored in the database."""
+    with conn:
+        create_events(conn.cursor())
+        conn.execute('DELETE FROM events')
+        conn.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(event.name, event.start, event.stop, json.dumps(event.table),
+                           event.classification, event.product, event.channel,
+                           event.html) for event in events])
+
+
+def load_events(conn, default=None):
+    """Return the events stored in the database.
 
     Arguments:
-        dbname -- database name
-        bug    -- a dict that store a bug action
+        conn    -- database connection
+        default -- event returned if none is stored (by default, the
+                   EVENT made of the module constants)
+
+    Returns:
+        List of Event instances
 
     """
+    events = []
+    for name, start, stop, points, classification, product, channel, html in \
+            conn.execute('SELECT * FROM events ORDER BY rowid'):
+        events.append(Event(name,
+                            datetime.strptime(start, '%Y-%m-%d %H:%M:%S'),
+                            datetime.strptime(stop, '%Y-%m-%d %H:%M:%S'),
+                            json.loads(points) if points else None,
+                            classification, product, channel, html))
+    return events or [default or Event(EVENT, START, STOP, channel=IRC_CHANNEL, html=HTML)]
 
-    conn = sqlite3.connect(dbname)
-    c = conn.cursor()
 
-    c.execute('SELECT * FROM ranking WHERE name=?', (bug['who'],))
-    row = c.fetchone()
-    (_, gold_fix, silver_fix, bronze_fix, other_fix,
-     gold_scr, silver_scr, bronze_scr, other_scr,
-     suspicious, other) = row if row else [0]*11
+def whiteboard_changed(bug):
+    """Tell if a bug action changes the status whiteboard."""
+    return (bug.type == 'changed' and
+            'Whiteboard' in bug.changed_fields)
+
+
+_EPOCH = datetime(1970, 1, 1)
+def ranking_interval(date_):
+    """Return the start of the RANKING_INTERVAL of a date, in seconds."""
+    seconds = int((date_ - _EPOCH).total_seconds())
+    return seconds - seconds % RANKING_INTERVAL
 
-    bugid = re.findall(r'\[Bug (\d+)\].*', bug['name'])[0]
+
+def evaluate(conn, bug, bot, events=None):
+    """Evaluate a bug action. Update the ranking of its events.
+
+    The bug action is classified once, and counted in the ranking of
+    each event, with the points of the event. The caller owns the
+    transaction.
+
+    Arguments:
+        conn   -- writer connection (see connect())
+        bug    -- BugAction instance
+        bot    -- BugBot instance used for the announcements, or None
+        events -- events of the bug action (see matching_events())
+
+    """
+    if events is None:
+        events = matching_events(bug)
+    bugid = bug.bugid
     evaluation = get_bug_evaluation(bugid)
+    action, bucket = _rules.classify(bug, evaluation)
 
-    status = [evaluation]
+    status = [evaluation, action]
 
-    if is_fix(bug):
-        status.append('FIX')
-        if evaluation == 'GOLD':
-            gold_fix += 1
-        elif evaluation == 'SILVER':
-            silver_fix += 1
-        elif evaluation == 'BRONZE':
-            bronze_fix += 1
+    msg = None
+    if bot and action == 'FIX':
+        if evaluation in ('GOLD', 'SILVER', 'BRONZE'):
+            msg, kind = '%s has fixed a %s bug! (BNC#%s)'%(bug.who, evaluation, bugid), 'fix'
         else:
-            other_fix += 1
-        if bot:
-            if evaluation in ('GOLD', 'SILVER', 'BRONZE'):
-                bot.say('%s has fixed a %s bug! (BNC#%s)'%(bug['who'], evaluation, bugid))
-            else:
-                bot.say('%s has fixed a bug! (BNC#%s)'%(bug['who'], bugid))
-
-    elif (is_scr(bug) or is_new(bug)) and not is_auto(bug):
-        status.append('SCR/NEW')
-        if evaluation == 'GOLD':
-            gold_scr += 1
-        elif evaluation == 'SILVER':
-            silver_scr += 1
-        elif evaluation == 'BRONZE':
-            bronze_scr += 1
+            msg, kind = '%s has fixed a bug! (BNC#%s)'%(bug.who, bugid), 'fix'
+    elif bot and action == 'SCR/NEW':
+        if evaluation in ('GOLD', 'SILVER', 'BRONZE'):
+            msg, kind = '%s has added more information in a %s bug! (BNC#%s)'%(bug.who, evaluation, bugid), 'scr'
+        elif bug.type == 'new':
+            msg, kind = '%s has created a new bug! (BNC#%s)'%(bug.who, bugid), 'new'
         else:
-            other_scr += 1
-        if bot:
-            if evaluation in ('GOLD', 'SILVER', 'BRONZE'):
-                bot.say('%s has added more information in a %s bug! (BNC#%s)'%(bug['who'], evaluation, bugid))
-            elif is_new(bug):
-                bot.say('%s has created a new bug! (BNC#%s)'%(bug['who'], bugid))
-            else:
-                bot.say('%s has added more information in BNC#%s!'%(bug['who'], bugid))
+            msg, kind = '%s has added more information in BNC#%s!'%(bug.who, bugid), 'scr'
+    if msg:
+        # Once in each channel, even if it has several events
+        channels = []
+        for event in events:
+            if event.channel and event.channel not in channels:
+                channels.append(event.channel)
+                bot.say(msg, kind, event.channel, bug.date)
+
+    column = COLUMNS[bucket]
+    interval = ranking_interval(bug.date)
+
+    print (bug.who, bugid, ','.join(status))
+
+    for event in events:
+        points = event.table.get(bucket, 0)
+
+        conn.execute("""INSERT OR IGNORE INTO ranking
+                        VALUES (?, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, ?)""",
+                     (bug.who, event.name))
+        conn.execute("""UPDATE ranking SET %s=%s+1, points=points+?
+                        WHERE event=? AND name=?""" % (column, column),
+                     (points, event.name, bug.who))
+
+        conn.execute("""INSERT OR IGNORE INTO ranking_history (interval, name, event)
+                        VALUES (?, ?, ?)""", (interval, bug.who, event.name))
+        conn.execute("""UPDATE ranking_history SET %s=%s+1, points=points+?
+                        WHERE event=? AND interval=? AND name=?""" % (column, column),
+                     (points, event.name, interval, bug.who))
+
+        conn.execute("""INSERT INTO ranking_log
+                        VALUES (?, ?, ?, ?)""",
+                     (bug.who,
+                      bugid,
+                      ','.join(status),
+                      event.name))
+
+
+def needs_body(bug):
+    """Tell if the classification of a bug action depends on its body.
+
+    The windows of the events are not checked, so the body is still
+    there when a window is widened and the timeline is replayed.
+
+    """
+    return _rules.needs_body(bug)
+
+
+def fetch_messages(srv, msgids, chunk=FETCH_CHUNK, all_bodies=False,
+                   uidvalidity=None):
+    """Fetch messages in chunks, and convert them into bug actions.
+
+    The headers are fetched first, and the body only for the messages
+    that need it (see needs_body()). Everything is fetched with PEEK,
+    so the messages stay unseen until the caller flags them.
+
+    A message without Message-ID is keyed by its UID instead (see
+    write_chunk()), if the UIDVALIDITY of the folder is given.
+
+    Arguments:
+        srv         -- IMAPClient instance
+        msgids      -- list of message UIDs to fetch
+        chunk       -- number of messages per fetch request
+        all_bodies  -- fetch the body of every message
+        uidvalidity -- UIDVALIDITY of the selected folder, or None
+
+    Returns:
+        A generator of (UIDs, bug actions) pairs, one for each chunk
+
+    """
+    for i in range(0, len(msgids), chunk):
+        uids = msgids[i:i+chunk]
+        with _metrics.timer('imap_fetch_seconds'):
+            messages = srv.fetch(uids, ('INTERNALDATE', 'ENVELOPE',
+                                        'BODY.PEEK[HEADER]'))
+        _metrics.observe('fetch_batch_messages', len(messages))
+
+        bugs = {}
+        with _metrics.timer('parse_seconds'):
+            for msgid, msg in messages.iteritems():
+                try:
+                    bug = bugs[msgid] = process_msg(msg)
+                except ValueError, e:
+                    _metrics.count('parse_errors')
+                    print 'Error processing the bug email: %s' % e
+                    continue
+                if bug.message_id is None and uidvalidity:
+                    bug.message_id = 'uid:%s:%d' % (uidvalidity, msgid)
+
+        wanted = [msgid for msgid, bug in bugs.iteritems()
+                  if all_bodies or needs_body(bug)]
+        if wanted:
+            with _metrics.timer('imap_fetch_body_seconds'):
+                bodies = srv.fetch(wanted, ('BODY.PEEK[TEXT]',))
+            for msgid, msg in bodies.iteritems():
+                bugs[msgid].set_body(msg['BODY[TEXT]'])
+        _metrics.count('messages', len(messages))
+        _metrics.count('bodies', len(wanted))
+
+        yield uids, [bugs[msgid] for msgid in sorted(bugs)]
+
+
+def prepare_chunk(bugs):
+    """Get the evaluations needed by a chunk of bug actions.
+
+    Arguments:
+        bugs -- list of BugAction instances
+
+    """
+    # A whiteboard change makes the cached evaluation stale
+    for bug in bugs:
+        if whiteboard_changed(bug):
+            _cache.invalidate(bug.bugid)
+
+    # Resolve all the evaluations needed by this chunk up front,
+    # instead of one Bugzilla round-trip per message
+    with _metrics.timer('bugzilla_prefetch_seconds'):
+        prefetch_bug_evaluations(bug.bugid for bug in bugs
+                                 if matching_events(bug))
+
+
+def write_chunk(conn, uids, bugs, bot=None):
+    """Store and evaluate a chunk of bug actions in a single transaction.
+
+    The highest UID of the chunk is recorded as the `last_uid` state
+    inside the same transaction, so it always points to the last
+    committed message. A message whose Message-ID (or UID, see
+    fetch_messages()) was already stored is skipped with a single
+    primary key lookup: it was pushed and then fetched from IMAP,
+    delivered twice, or committed but not flagged before a crash.
+
+    Arguments:
+        conn -- writer connection (see connect())
+        uids -- list of the message UIDs of the chunk
+        bugs -- list of BugAction instances, in UID order
+        bot  -- BugBot instance used for the announcements, or None
+
+    Returns:
+        Number of bug actions stored (the duplicates are not)
 
-    elif is_suspicious(bug) or is_reopen(bug):
-        status.append('SUSPICIOUS/REOPEN')
-        suspicious += 1
+    """
+    stored = 0
+    with _metrics.timer('db_write_seconds'):
+        with conn:
+            for bug in bugs:
+                if bug.message_id and not conn.execute(
+                        'INSERT OR IGNORE INTO messages VALUES (?)',
+                        (bug.message_id,)).rowcount:
+                    _metrics.count('duplicates')
+                    continue
+                store(conn, bug)
+                stored += 1
+                events = matching_events(bug)
+                if events:
+                    evaluate(conn, bug, bot, events)
+            last_uid = int(get_state(conn, 'last_uid', 0))
+            set_state(conn, 'last_uid', max([last_uid] + uids))
+        _cache.flush()
+    return stored
+
+
+class Pipeline(object):
+    """Ingest stages running concurrently, connected by bounded queues.
+
+    The caller thread is the IMAP fetcher: it owns the IMAP connection,
+    fetches and parses the chunks (the parsed headers decide which
+    bodies are fetched), and flags the committed messages as seen. A
+    pool of `workers` threads resolves the Bugzilla evaluations, and a
+    single writer thread owns the database connection. Other sources
+    (see push_ingest()) add chunks with submit().
+
+    Chunks are numbered when fetched and written strictly in that
+    order, so the ranking sees every bug action in the order of the
+    UIDs, as if the chunks were processed one after the other.
+
+    Nobody waits for the chunks of the other sources, so the writer
+    calls `committed` (if given, with no arguments) after it commits
+    one of them, to publish the new ranking.
+
+    """
+
+    def __init__(self, dbname, bot=None, workers=BZ_WORKERS, depth=PIPELINE_DEPTH,
+                 committed=None):
+        self.dbname = dbname
+        self.bot = bot
+        self.committed = committed
+        self._evaluate = Queue.Queue(depth)
+        self._write = Queue.Queue(depth)
+        self._done = Queue.Queue()
+        self._error = None
+        self._seq = 0
+        self._lock = threading.Lock()
+        for _ in range(workers):
+            self._start(self._evaluator)
+        self._start(self._writer)
+
+    def _start(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def depths(self):
+        """Return the number of chunks waiting for each stage."""
+        return {
+            'evaluate': self._evaluate.qsize(),
+            'write': self._write.qsize(),
+            'flag': self._done.qsize(),
+        }
+
+    def submit(self, uids, bugs, done=None):
+        """Add a chunk of bug actions to the pipeline.
+
+        Arguments:
+            uids -- list of the IMAP UIDs of the chunk (empty if the
+                    messages do not come from IMAP)
+            bugs -- list of BugAction instances
+            done -- Queue.Queue that gets `uids` once the chunk is
+                    committed, or None if it was not
+
+        """
+        with self._lock:
+            self._evaluate.put((self._seq, uids, bugs, done))
+            self._seq += 1
+
+    def _evaluator(self):
+        while True:
+            seq, uids, bugs, done = self._evaluate.get()
+            try:
+                prepare_chunk(bugs)
+            except Exception, e:
+                # The writer falls back to the per-bug lookups
+                print 'Error evaluating a chunk: %s' % e
+            self._write.put((seq, uids, bugs, done))
+
+    def _writer(self):
+        conn = connect(self.dbname)
+        pending = {}
+        seq = 0
+        while True:
+            item = self._write.get()
+            pending[item[0]] = item
+            while seq in pending:
+                _, uids, bugs, done = pending.pop(seq)
+                seq += 1
+                result = None
+                if self._error and uids:
+                    # Keep the UID order: no IMAP chunk after a failed
+                    # one is committed
+                    pass
+                else:
+                    try:
+                        write_chunk(conn, uids, bugs, self.bot)
+                        result = uids
+                    except Exception, e:
+                        print 'Error writing a chunk: %s' % e
+                        if uids:
+                            self._error = e
+                if done:
+                    done.put(result)
+                elif result is not None and self.committed:
+                    try:
+                        self.committed()
+                    except Exception, e:
+                        print 'Error publishing a chunk: %s' % e
+
+    def run(self, srv, msgids, all_bodies=False, uidvalidity=None):
+        """Process messages, and return when all of them are committed.
+
+        Arguments:
+            srv         -- IMAPClient instance
+            msgids      -- list of message UIDs to fetch
+            all_bodies  -- fetch and store the body of every message
+            uidvalidity -- UIDVALIDITY of the selected folder, or None
+
+        """
+        if not msgids:
+            return
+
+        print 'Processing %d unread messages...' % len(msgids)
+        self._error = None
+        sent = done = 0
+        for uids, bugs in fetch_messages(srv, sorted(msgids), all_bodies=all_bodies,
+                                         uidvalidity=uidvalidity):
+            self.submit(uids, bugs, self._done)
+            sent += 1
+            while not self._done.empty():
+                self._flag(srv, self._done.get())
+                done += 1
+        while done < sent:
+            self._flag(srv, self._done.get())
+            done += 1
+
+        if self._error:
+            raise self._error
+
+    def _flag(self, srv, uids):
+        if uids:
+            srv.add_flags(uids, ['\\Seen'])
+
+
+def mbox_ranges(path):
+    """Find the messages of an mbox file, without reading it in memory.
+
+    Returns:
+        List of the (start, end) offsets of each message, "From " line
+        included
+
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        starts = [0] if mm[:5] == 'From ' else []
+        pos = mm.find('\nFrom ')
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = mm.find('\nFrom ', pos + 1)
+        return zip(starts, starts[1:] + [len(mm)])
+    finally:
+        mm.close()
+
+
+_DATE = re.compile(r'(?:^|\n)Date:[ \t]*([^\r\n]*)')
+def archive_date(raw, from_line=None, start=0, end=None, default=None):
+    """Return the delivery date of the archived mail in raw[start:end].
+
+    The date of the mbox "From " line is used if possible, then the
+    Date header, then `default` (or the current time).
+
+    """
+    if from_line:
+        try:
+            return datetime.strptime(from_line.split(None, 2)[2].strip(),
+                                     '%a %b %d %H:%M:%S %Y')
+        except (IndexError, ValueError):
+            pass
+    match = _DATE.search(raw, start, len(raw) if end is None else end)
+    parsed = email.utils.parsedate(match.group(1)) if match else None
+    return datetime(*parsed[:6]) if parsed else default or datetime.now()
+
+
+def maildir_date(filename):
+    """Return the delivery time that starts the name of a Maildir file,
+    or None if the name does not start with one."""
+    stamp = os.path.basename(filename).split('.', 1)[0]
+    return datetime.fromtimestamp(int(stamp)) if stamp.isdigit() else None
+
+
+_import = {}
+def _import_init(all_bodies):
+    """Prepare an import worker."""
+    _import['all_bodies'] = all_bodies
+    _import['mbox'] = {}
+
+
+def _import_mail(raw, date_, start=0, end=None):
+    try:
+        bug = parse_mail(raw, date_, start, end)
+    except ValueError:
+        return None
+    # Store the same bodies as the IMAP path. Only the kept ones are
+    # copied out of the archive, to be sent to the parent process.
+    if _import['all_bodies'] or needs_body(bug):
+        bug.set_body(bug.body)
     else:
-        status.append('OTHER')
-        other += 1
+        bug.set_body(None)
+    return bug
 
-    print (bug['who'], gold_fix, silver_fix, bronze_fix, other_fix,
-           gold_scr, silver_scr, bronze_scr, other_scr, suspicious, other)
-    print (bug['who'], bugid, ','.join(status))
 
-    if row:
-        c.execute("""UPDATE ranking
-                     SET gold_fix=?,
-                         silver_fix=?,
-                         bronze_fix=?,
-                         other_fix=?,
-                         gold_scr=?,
-                         silver_scr=?,
-                         bronze_scr=?,
-                         other_scr=?,
-                         suspicious=?,
-                         other=?
-                     WHERE name=?""", 
-                  (gold_fix,
-                   silver_fix,
-                   bronze_fix,
-                   other_fix,
-                   gold_scr,
-                   silver_scr,
-                   bronze_scr,
-                   other_scr,
-                   suspicious,
-                   other,
-                   bug['who']))
+def _import_chunk(task):
+    """Parse a chunk of archived mails (import worker).
+
+    Arguments:
+        task -- ('mbox', path, offsets) or ('maildir', None, filenames)
+
+    Returns:
+        A (bugs, errors) tuple, with the BugAction instances in archive
+        order, and the number of mails that are not bug notifications
+
+    """
+    kind, path, items = task
+    bugs = []
+    if kind == 'mbox':
+        if path not in _import['mbox']:
+            with open(path, 'rb') as f:
+                _import['mbox'][path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = _import['mbox'][path]
+        # The mails are parsed in place: only the "From " line, the
+        # headers and the kept bodies are copied out of the mmap
+        for start, end in items:
+            eol = mm.find('\n', start, end)
+            if eol == -1:
+                continue
+            date_ = archive_date(mm, mm[start:eol], eol + 1, end)
+            bugs.append(_import_mail(mm, date_, eol + 1, end))
     else:
-        c.execute("""INSERT INTO ranking
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-                  (bug['who'],
-                   gold_fix,
-                   silver_fix,
-                   bronze_fix,
-                   other_fix,
-                   gold_scr,
-                   silver_scr,
-                   bronze_scr,
-                   other_scr,
-                   suspicious,
-                   other))
-
-    c.execute("""INSERT INTO ranking_log
-                 VALUES (?, ?, ?)""", 
-              (bug['who'],
-               bugid,
-               ','.join(status)))
+        for filename in items:
+            with open(filename, 'rb') as f:
+                raw = f.read()
+            # The modification time is the one of a copy of the archive
+            date_ = maildir_date(filename) or archive_date(
+                raw, default=datetime.fromtimestamp(os.path.getmtime(filename)))
+            bugs.append(_import_mail(raw, date_))
+
+    return [bug for bug in bugs if bug], bugs.count(None)
+
+
+def import_mail(conn, path, bot=None, processes=None, all_bodies=False):
+    """Import the Bugzilla mails of an mbox file or a Maildir.
+
+    The archive is split in chunks of IMPORT_CHUNK mails, parsed by a
+    pool of worker processes. An mbox file is memory-mapped, so the
+    messages are found and parsed without loading the whole file or
+    copying them. A Maildir is read in delivery order, by the file
+    names of cur/ and new/ together, and the date of a mail is the
+    delivery time in its name (or its Date header). Each chunk is then
+    evaluated and written like an IMAP chunk (see prepare_chunk() and
+    write_chunk()), and messages already stored are skipped by
+    Message-ID, so an archive can be imported again.
 
-    conn.commit()
-    conn.close()
+    Arguments:
+        conn       -- writer connection (see connect())
+        path       -- mbox file, Maildir, or directory of mail files
+        bot        -- BugBot instance used for the announcements, or None
+        processes  -- number of worker processes (default: one per CPU)
+        all_bodies -- store the body of every message
 
+    Returns:
+        A (imported, skipped) tuple with the number of bug actions
+        stored, and of mails skipped (already stored, or not bug
+        notifications)
 
-def process(dbname, msgids, bot=None):
-    messages = srv.fetch(msgids, ('FLAGS', 'INTERNALDATE', 'ENVELOPE',
-                                  'BODY[HEADER]', 'BODY[TEXT]'))
-    print 'Processing %d unread messages...' % len(messages)
-    for msgid, msg in messages.iteritems():
-        try:
-            bug = process_msg(msg)
-        except:
-            print 'Error processing the bug email [%s]'%msg['ENVELOPE'][1]
+    """
+    if os.path.isdir(path):
+        folders = [os.path.join(path, d) for d in ('cur', 'new')
+                   if os.path.isdir(os.path.join(path, d))] or [path]
+        # Maildir names start with the delivery time
+        filenames = sorted((os.path.join(folder, name) for folder in folders
+                            for name in os.listdir(folder)
+                            if not name.startswith('.')),
+                           key=os.path.basename)
+        tasks = [('maildir', None, filenames[i:i+IMPORT_CHUNK])
+                 for i in range(0, len(filenames), IMPORT_CHUNK)]
+    else:
+        ranges = mbox_ranges(path)
+        tasks = [('mbox', path, ranges[i:i+IMPORT_CHUNK])
+                 for i in range(0, len(ranges), IMPORT_CHUNK)]
+
+    pool = multiprocessing.Pool(processes, _import_init, (all_bodies,))
+    imported = skipped = 0
+    try:
+        for bugs, errors in pool.imap(_import_chunk, tasks):
+            prepare_chunk(bugs)
+            stored = write_chunk(conn, [], bugs, bot)
+            imported += stored
+            skipped += errors + len(bugs) - stored
+    finally:
+        pool.close()
+        pool.join()
+    return imported, skipped
+
+
+ReplayRow = collections.namedtuple('ReplayRow',
+                                   'interval date bugid who type status changed_fields '
+                                   'classification product body')
+
+_replay = {}
+def _replay_init(dbname, evaluations, events):
+    """Open the database in a replay worker."""
+    _replay['conn'] = connect(dbname)
+    # Skip the UTF-8 decoding, the rows are only classified
+    _replay['conn'].text_factory = str
+    _replay['evaluations'] = evaluations
+    # The windows in the format of the timeline dates, so they are
+    # compared without parsing the dates
+    _replay['events'] = [(str(event.start), str(event.stop), event) for event in events]
+
+
+def _replay_chunk(ids):
+    """Classify the timeline rows in a range of ids (replay worker).
+
+    Returns:
+        A (history, log, missing) tuple. `history` maps each (interval,
+        user, event) to the counters of the ranking columns and the
+        points (see ranking_interval()), `log` has the ranking_log rows,
+        in timeline order, and `missing` is the number of rows classified
+        without the body they need
+
+    """
+    evaluations = _replay['evaluations']
+    windows = _replay['events']
+    history = {}
+    log = []
+    missing = 0
+    # The interval is computed by SQLite, as ranking_interval() does
+    for row in _replay['conn'].execute("""SELECT CAST(strftime('%%s', date) AS INTEGER) / %d * %d,
+                                                 date, bugid, who, type, status,
+                                                 changed_fields, classification,
+                                                 product, body
+                                          FROM timeline_text
+                                          WHERE id BETWEEN ? AND ?
+                                            AND date >= ? AND date < ?
+                                          ORDER BY id""" % (RANKING_INTERVAL, RANKING_INTERVAL),
+                                       ids + (min(w[0] for w in windows),
+                                              max(w[1] for w in windows))):
+        bug = ReplayRow._make(row)
+        events = [event for start, stop, event in windows
+                  if start <= bug.date < stop and event.accepts(bug)]
+        if not events:
             continue
+        if bug.body is None and _rules.needs_body(bug):
+            missing += 1
+        bugid = str(bug.bugid)
+        evaluation = evaluations.get(bugid, 'OTHER')
+        action, bucket = _rules.classify(bug, evaluation)
+        column = COLUMNS[bucket]
+
+        for event in events:
+            log.append((bug.who, bugid, '%s,%s' % (evaluation, action), event.name))
+
+            key = (bug.interval, bug.who, event.name)
+            if key not in history:
+                history[key] = dict.fromkeys(RANKING[1:], 0)
+            counters = history[key]
+            counters[column] += 1
+            counters['points'] += event.table.get(bucket, 0)
+    return history, log, missing
+
+
+def replay(conn, dbname, processes=None):
+    """Rebuild ranking, ranking_history and ranking_log from the timeline.
+
+    The rows inside the window of an event are classified again with
+    the current rules, and counted for every event with its points
+    table, split in id ranges across a pool of worker processes that
+    read the timeline by themselves.
+    The evaluations come from the cache, and the missing ones are
+    prefetched in bulk before starting, like the live path does.
+    The bodies of the mails outside of the windows were not stored
+    before, nor the ones the old rules did not read, so a warning tells
+    how many rows were classified without their body.
 
-        store(dbname, bug)
-        if START <= bug['date'] < STOP:
-            evaluate(dbname, bug, bot)
+    Arguments:
+        conn      -- writer connection (see connect())
+        dbname    -- database name, opened again by every worker
+        processes -- number of worker processes (default: one per CPU)
 
+    Returns:
+        Number of bug actions counted (once for each of their events)
+
+    """
+    window = (min(event.start for event in _events),
+              max(event.stop for event in _events))
+    bugids = [str(r[0]) for r in conn.execute("""SELECT DISTINCT bugid FROM timeline
+                                                 WHERE date >= ? AND date < ?""",
+                                              window)]
+    prefetch_bug_evaluations(bugids)
+    evaluations = dict((bugid, get_bug_evaluation(bugid)) for bugid in bugids)
+    _cache.flush()
+
+    first, last = conn.execute("""SELECT MIN(rowid), MAX(rowid) FROM timeline
+                                  WHERE date >= ? AND date < ?""", window).fetchone()
+    ranges = [(i, min(i + REPLAY_CHUNK - 1, last))
+              for i in range(first or 0, (last or -1) + 1, REPLAY_CHUNK)]
+
+    pool = multiprocessing.Pool(processes, _replay_init, (dbname, evaluations, _events))
+    history = {}
+    count = 0
+    missing = 0
+    try:
+        with conn:
+            conn.execute('DELETE FROM ranking')
+            conn.execute('DELETE FROM ranking_history')
+            conn.execute('DELETE FROM ranking_log')
+            for chunk_history, log, chunk_missing in pool.imap(_replay_chunk, ranges):
+                missing += chunk_missing
+                for key, counters in chunk_history.iteritems():
+                    if key not in history:
+                        history[key] = counters
+                    else:
+                        for column, value in counters.iteritems():
+                            history[key][column] += value
+                conn.executemany('INSERT INTO ranking_log VALUES (?, ?, ?, ?)', log)
+                count += len(log)
+
+            totals = {}
+            for (interval, who, event), counters in history.iteritems():
+                if (who, event) not in totals:
+                    totals[who, event] = dict(counters)
+                else:
+                    for column, value in counters.iteritems():
+                        totals[who, event][column] += value
+
+            conn.executemany("""INSERT INTO ranking_history
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                             [key[:2] + tuple(row[column] for column in RANKING[1:]) + key[2:]
+                              for key, row in history.iteritems()])
+            conn.executemany("""INSERT INTO ranking
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                             [(who,) + tuple(row[column] for column in RANKING[1:]) + (event,)
+                              for (who, event), row in totals.iteritems()])
+    finally:
+        pool.close()
+        pool.join()
+
+    if missing:
+        print ('Warning: %d bug actions were classified without their body, '
+               'which was not stored (store it with --all-bodies)' % missing)
+    return count
+
+
+# Columns of a ranking row, as returned by ranking()
+RANKING = ('name', 'gold_fix', 'silver_fix', 'bronze_fix', 'other_fix',
+           'gold_scr', 'silver_scr', 'bronze_scr', 'other_scr',
+           'suspicious', 'other', 'points')
+
+
+def ranking(dbname, html=False, limit=None, at=None, event=EVENT):
+    """Return the ranking of an event, sorted by points.
+
+    Arguments:
+        dbname -- database name
+        html   -- render the ranking as an HTML page
+        limit  -- return only the top `limit` users
+        at     -- return the ranking at this time (a datetime), summing
+                  the ranking_history intervals that start before it
+        event  -- name of the event
 
-def ranking(dbname, html=False):
+    """
     conn = sqlite3.connect(dbname)
     c = conn.cursor()
-    c.execute('SELECT * FROM ranking')
-
-    table = []
-    for row in c:
-        table.append(list(row))
-        l = table[-1]
-        points = (l[1] * TABLE['FIX GOLD'] +
-                  l[2] * TABLE['FIX SILVER'] +
-                  l[3] * TABLE['FIX BRONZE'] +
-                  l[4] * TABLE['FIX OTHER'] +
-                  l[5] * TABLE['SCR GOLD'] +
-                  l[6] * TABLE['SCR SILVER'] +
-                  l[7] * TABLE['SCR BRONZE'] +
-                  l[8] * TABLE['SCR OTHER'])
-        l.append(points)
-
+    if at:
+        query = """SELECT name, %s FROM ranking_history
+                   WHERE event=? AND interval < ?
+                   GROUP BY name
+                   ORDER BY points DESC""" % ', '.join(
+            'SUM(%s) AS %s' % (column, column) for column in RANKING[1:])
+        params = (event, ranking_interval(at))
+    else:
+        query = """SELECT %s FROM ranking
+                   WHERE event=?
+                   ORDER BY points DESC""" % ', '.join(RANKING)
+        params = (event,)
+    if limit:
+        query += ' LIMIT ?'
+        params += (limit,)
+    c.execute(query, params)
+    table = [list(row) for row in c]
     conn.close()
-    table.sort(key=lambda x: x[-1], reverse=True)
 
     if not html:
         return table
+    return render_html(table, ranking_title(event, at))
+
+
+def ranking_title(event, at=None):
+    """Return the title of the ranking of an event."""
+    title = 'Ranking' if event == EVENT else '%s ranking' % event
+    if at:
+        title += ' at %s' % at.strftime('%Y-%m-%d %H:%M')
+    return title
 
-    table_html = """<!DOCTYPE HTML>
+
+def history(dbname, name, event=EVENT):
+    """Return the points of a user over time, in an event.
+
+    Returns:
+        List of (datetime, points) pairs, one for each interval with
+        activity, with the total points at the end of the interval
+
+    """
+    conn = sqlite3.connect(dbname)
+    rows = conn.execute("""SELECT interval, points FROM ranking_history
+                           WHERE event=? AND name=? ORDER BY interval""",
+                        (event, name)).fetchall()
+    conn.close()
+
+    result = []
+    total = 0
+    for interval, points in rows:
+        total += points
+        result.append((_EPOCH + timedelta(seconds=interval + RANKING_INTERVAL), total))
+    return result
+
+
+def parse_time(text, day=None):
+    """Parse '[YYYY-MM-DD] HH:MM' (the day of `day`, or of START, if
+    omitted), or None."""
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    try:
+        return datetime.combine((day or START).date(),
+                                datetime.strptime(text, '%H:%M').time())
+    except ValueError:
+        return None
+
+
+def render_html(table, title='Ranking'):
+    """Render a ranking as an HTML page."""
+    rows = ''.join('\n<tr>' + ''.join('<td>%s</td>'%cgi.escape(unicode(v)) for v in line) + '</tr>'
+                   for line in table)
+    return """<!DOCTYPE HTML>
 <html lang = "en">
   <head>
     <title>Beta Pizza Hackathon Ranking</title>
@@ -498,9 +2380,15 @@ def ranking(dbname, html=False):
       border: 1px solid black;
     } 
     </style>
+    <script type="text/javascript">
+    // Reload as soon as the ranking changes, when served by bugmonitor
+    if (window.EventSource && location.protocol != 'file:') {
+      new EventSource('events' + location.search).onmessage = function() { location.reload(); };
+    }
+    </script>
   </head>
   <body>
-    <h1>Ranking</h1>
+    <h1>%s</h1>
     <table>
       <tr>
         <th>User</th>
@@ -515,14 +2403,374 @@ def ranking(dbname, html=False):
         <th>Suspicious</th>
         <th>Other</th>
         <th>Total</th>
-      </tr>"""
-    for line in table:
-        table_html += '\n<tr>' + ''.join('<td>%s</td>'%v for v in line) + '</tr>'
-    table_html += """
+      </tr>%s
     </table>
   </body>
-</html>"""
-    return table_html
+</html>""" % (cgi.escape(title), rows)
+
+
+class Leaderboard(object):
+    """The ranking of an event, rendered once each time it changes.
+
+    Keeps the HTML and JSON views with an ETag, and lets the HTTP
+    handlers wait for the next change.
+
+    """
+
+    def __init__(self, dbname, event=None):
+        self.dbname = dbname
+        self.event = event or _events[0]
+        self.etag = None
+        self.views = {}
+        self._changed = threading.Condition()
+
+    def update(self):
+        """Render the ranking again. Return True if it changed."""
+        table = ranking(self.dbname, event=self.event.name)
+        data = json.dumps([dict(zip(RANKING, row)) for row in table])
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if etag == self.etag:
+            return False
+
+        views = {
+            'json': data,
+            'html': render_html(table, ranking_title(self.event.name)).encode('utf-8'),
+        }
+        with self._changed:
+            self.etag = etag
+            self.views = views
+            self._changed.notify_all()
+        return True
+
+    def wait(self, etag, timeout=HTTP_WAIT):
+        """Wait until the ETag is not `etag`. Return the current ETag."""
+        deadline = time.time() + timeout
+        with self._changed:
+            while self.etag == etag and time.time() < deadline:
+                self._changed.wait(deadline - time.time())
+            return self.etag
+
+
+class LeaderboardHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the leaderboard.
+
+    /, /ranking.html -- HTML view
+    /ranking.json    -- JSON view
+    /events          -- server-sent events, one for each change
+    /history.json    -- points of the `name` user over time
+    /metrics         -- ingest metrics, in the Prometheus text format
+
+    The views honor If-None-Match. With a `wait` query parameter, a
+    request that would get a 304 is held until the ranking changes
+    (or HTTP_WAIT seconds pass). With an `at` query parameter (see
+    parse_time()) they show the ranking at that time instead. All of
+    them are for the event named by the `event` query parameter, or
+    for the first event.
+
+    """
+
+    TYPES = {
+        'html': 'text/html; charset=UTF-8',
+        'json': 'application/json',
+    }
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        view = {
+            '/': 'html',
+            '/ranking.html': 'html',
+            '/ranking.json': 'json',
+        }.get(url.path)
+
+        if url.path == '/metrics':
+            self.send_body(_metrics.render(), 'text/plain; version=0.0.4')
+            return
+        # A bare ?wait has a blank value
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+        leaderboards = self.server.leaderboards
+        leaderboard = leaderboards.get(query.get('event', [''])[0]
+                                       or next(iter(leaderboards)))
+        if not leaderboard:
+            self.send_error(404)
+            return
+        event = leaderboard.event
+
+        if url.path == '/events':
+            self.events(leaderboard)
+            return
+        if url.path == '/history.json' and 'name' in query:
+            points = history(leaderboard.dbname, query['name'][0], event.name)
+            self.send_body(json.dumps([(d.isoformat(), p) for d, p in points]),
+                           self.TYPES['json'])
+            return
+        if not view:
+            self.send_error(404)
+            return
+        if 'at' in query:
+            at = parse_time(query['at'][0], event.start)
+            if not at:
+                self.send_error(400)
+            elif view == 'json':
+                table = ranking(leaderboard.dbname, at=at, event=event.name)
+                self.send_body(json.dumps([dict(zip(RANKING, row)) for row in table]),
+                               self.TYPES[view])
+            else:
+                self.send_body(ranking(leaderboard.dbname, html=True, at=at,
+                                       event=event.name).encode('utf-8'),
+                               self.TYPES[view])
+            return
+
+        etag = self.headers.get('If-None-Match')
+        if etag and etag == leaderboard.etag and 'wait' in query:
+            leaderboard.wait(etag)
+
+        current = leaderboard.etag
+        if not current:
+            self.send_error(503)
+            return
+        if etag == current:
+            self.send_response(304)
+            self.send_header('ETag', current)
+            self.end_headers()
+            return
+
+        body = leaderboard.views[view]
+        self.send_response(200)
+        self.send_header('Content-Type', self.TYPES[view])
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', current)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def events(self, leaderboard):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        etag = self.headers.get('Last-Event-ID', leaderboard.etag)
+        try:
+            while True:
+                current = leaderboard.wait(etag)
+                if current == etag:
+                    self.wfile.write(': keep-alive\n\n')
+                else:
+                    etag = current
+                    self.wfile.write('id: %s\ndata: %s\n\n' % (etag, leaderboard.views['json']))
+                self.wfile.flush()
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LeaderboardServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, leaderboards):
+        BaseHTTPServer.HTTPServer.__init__(self, ('', port), LeaderboardHandler)
+        # Ordered dictionary of event name to Leaderboard
+        self.leaderboards = leaderboards
+
+
+class MailChannel(asyncore.dispatcher):
+    """Connection of the push listener. The mail ends with the connection."""
+
+    def __init__(self, sock, listener):
+        asyncore.dispatcher.__init__(self, sock)
+        self.listener = listener
+        self.data = []
+        self.size = 0
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(65536)
+        # recv() calls handle_close() itself at the end of the mail
+        if not data or self.data is None:
+            return
+        self.data.append(data)
+        self.size += len(data)
+        if self.size > PUSH_SIZE:
+            print 'Pushed mail larger than %d bytes, dropped' % PUSH_SIZE
+            _metrics.count('push_dropped')
+            self.data = None
+            self.close()
+
+    def handle_close(self):
+        self.close()
+        if self.data:
+            self.listener.deliver(''.join(self.data))
+            self.data = None
+
+
+class PushListener(asyncore.dispatcher):
+    """Accept raw RFC822 mails over TCP, one per connection.
+
+    This is the protocol of the MailListener of bot.rb, so an MTA can
+    pipe each Bugzilla notification to the bot as soon as it arrives.
+    All the connections are served by one asyncore loop (see run()),
+    and the mails are queued for push_ingest(). When the queue is full
+    the mail is dropped: the IMAP copy is processed later instead.
+
+    """
+
+    def __init__(self, port, host=''):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.queue = Queue.Queue(PUSH_QUEUE)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair:
+            MailChannel(pair[0], self)
+
+    def deliver(self, raw):
+        try:
+            self.queue.put_nowait((datetime.now(), raw))
+            _metrics.count('push_messages')
+        except Queue.Full:
+            _metrics.count('push_dropped')
+
+    def run(self):
+        """Serve the connections, forever."""
+        asyncore.loop(timeout=30)
+
+
+def push_ingest(listener, pipeline, all_bodies=False,
+                batch=PUSH_BATCH, delay=PUSH_DELAY):
+    """Process the mails of a PushListener, forever.
+
+    The mails that arrive within `delay` seconds of the first one are
+    processed together, in chunks of at most `batch` mails.
+
+    Arguments:
+        listener   -- PushListener instance
+        pipeline   -- Pipeline instance
+        all_bodies -- store the body of every message
+
+    """
+    while True:
+        mails = [listener.queue.get()]
+        deadline = time.time() + delay
+        while len(mails) < batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                mails.append(listener.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+
+        bugs = []
+        for date_, raw in mails:
+            try:
+                bug = parse_mail(raw, date_)
+            except ValueError, e:
+                _metrics.count('parse_errors')
+                print 'Error processing the pushed email: %s' % e
+                continue
+            # Store the same bodies as the IMAP path
+            if not (all_bodies or needs_body(bug)):
+                bug.set_body(None)
+            bugs.append(bug)
+        _metrics.observe('push_batch_messages', len(mails))
+        if bugs:
+            pipeline.submit([], bugs)
+
+
+def publish(leaderboards):
+    """Refresh the leaderboard of each event, and write the HTML files
+    of the ones that changed."""
+    for leaderboard in leaderboards.itervalues():
+        html = leaderboard.event.html
+        if leaderboard.update() and html:
+            with open(html, 'w') as f:
+                f.write(leaderboard.views['html'])
+
+
+def search(dbname, terms, page=1, size=SEARCH_PAGE):
+    """Search the subject and body of the stored messages.
+
+    Only the bodies stored in the timeline are searched: without
+    --all-bodies, those are the ones the classification reads, so the
+    bodies of most mails (the fixes, for example) are not searchable.
+    Every term must be found. The SEARCH_WINDOW most
+    recent matches are sorted by relevance (bm25), so the cost of a
+    search does not grow with the timeline, even for common terms.
+
+    Arguments:
+        dbname -- database name
+        terms  -- words to search, separated by spaces
+        page   -- page of results, starting at 1
+        size   -- number of results in a page
+
+    Returns:
+        A (results, more) tuple, or None if SQLite has no full-text
+        search. `results` is a list of (date, bugid, who, subject)
+        tuples, and `more` tells if there is a next page
+
+    """
+    # Every term is a quoted string, so the FTS5 query syntax does not
+    # apply to user input
+    query = ' '.join('"%s"' % term.replace('"', '""') for term in terms.split())
+    if not query:
+        return [], False
+
+    conn = sqlite3.connect(dbname)
+    conn.create_function('inflate', 1, inflate)
+    if not conn.execute("""SELECT 1 FROM sqlite_master
+                           WHERE type='table' AND name='timeline_fts'""").fetchone():
+        conn.close()
+        return None
+    # Only the rows of the page are read from the timeline
+    try:
+        rows = conn.execute("""SELECT t.date, t.bugid, t.who, t.name
+                               FROM (SELECT rowid, score FROM
+                                         (SELECT rowid, bm25(timeline_fts) AS score
+                                          FROM timeline_fts
+                                          WHERE timeline_fts MATCH ?
+                                          ORDER BY rowid DESC LIMIT ?)
+                                     ORDER BY score LIMIT ? OFFSET ?) AS r
+                               JOIN timeline_text t ON t.id=r.rowid
+                               ORDER BY r.score""",
+                            (query, SEARCH_WINDOW, size + 1, (page - 1) * size)).fetchall()
+    except sqlite3.OperationalError, e:
+        # The index was created by a SQLite with FTS5
+        if not str(e).startswith('no such module'):
+            raise
+        return None
+    finally:
+        conn.close()
+    return rows[:size], len(rows) > size
+
+
+def rank(dbname, name, event=EVENT):
+    """Return the position and points of a user in an event, or None if
+    not ranked."""
+    conn = sqlite3.connect(dbname)
+    c = conn.cursor()
+    c.execute('SELECT points FROM ranking WHERE event=? AND name=?', (event, name))
+    row = c.fetchone()
+    if row:
+        c.execute('SELECT COUNT(*) FROM ranking WHERE event=? AND points>?',
+                  (event,) + row)
+        row = (c.fetchone()[0] + 1, row[0])
+    conn.close()
+    return row
 
 
 if __name__ == '__main__':
@@ -530,6 +2778,9 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--initdb', action='store_true',
                         help='initialize the database (CAUTION)')
     parser.add_argument('-d', '--db', default=DBNAME, help='database name')
+    parser.add_argument('--compact', action='store_true',
+                        help='store the timeline in the compact format '
+                        '(converts an existing database)')
     parser.add_argument('--imap-host', default=IMAP_HOST, help='IMAP server')
     parser.add_argument('--imap-user', default=IMAP_USERNAME, help='IMAP user name')
     parser.add_argument('--imap-password', default=IMAP_PASSWORD, help='IMAP password')
@@ -538,6 +2789,43 @@ if __name__ == '__main__':
     parser.add_argument('--bz-host', default=BZ_HOST, help='bugzilla server')
     parser.add_argument('--bz-user', default=BZ_USERNAME, help='bugzilla user name')
     parser.add_argument('--bz-password', default=BZ_PASSWORD, help='bugzilla password')
+    parser.add_argument('--all-bodies', action='store_true',
+                        help='store the body of every message, not only '
+                        'the ones needed for the classification')
+    parser.add_argument('--replay', action='store_true',
+                        help='rebuild the ranking from the stored timeline and exit')
+    parser.add_argument('--import', dest='import_path', metavar='PATH',
+                        help='import the mails of an mbox file or a Maildir and exit')
+    parser.add_argument('--search', metavar='TERMS',
+                        help='search the stored bug mails and exit (the '
+                        'subjects, and only the bodies stored for the '
+                        'classification, see --all-bodies)')
+    parser.add_argument('--page', type=int, default=1,
+                        help='page of --search results')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes used by --replay and --import')
+    parser.add_argument('--rules', help='JSON file with the classification rules')
+    parser.add_argument('--events', metavar='FILE',
+                        help='JSON file with the events to run, stored in the '
+                        'database (without events, the default one uses '
+                        '--channel and --html)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help='number of bug evaluations (and of bug titles) '
+                        'kept in memory')
+    parser.add_argument('--cache-ttl', type=int, default=CACHE_TTL,
+                        help='seconds a bug evaluation is considered valid')
+    parser.add_argument('--bz-workers', type=int, default=BZ_WORKERS,
+                        help='concurrent Bugzilla evaluation workers')
+    parser.add_argument('--html', default=HTML,
+                        help='HTML file updated with the ranking')
+    parser.add_argument('--metrics-file',
+                        help='write the ingest metrics (Prometheus text '
+                        'format) in this file after each batch')
+    parser.add_argument('--http-port', type=int, default=HTTP_PORT,
+                        help='serve the ranking over HTTP on this port')
+    parser.add_argument('--push-port', type=int, default=PUSH_PORT,
+                        help='accept raw mails pushed over TCP on this port '
+                        '(IMAP is still used to catch up)')
     parser.add_argument('--irc-host', default=IRC_HOST, help='IRC server')
     parser.add_argument('--nick', default=IRC_NICK, help='IRC nick name')
     parser.add_argument('--channel', default=IRC_CHANNEL, help='IRC channel')
@@ -549,36 +2837,151 @@ if __name__ == '__main__':
 
     if args.initdb:
         print 'Reseting the database.'''
-        initdb(dbname)
-
-    srv = login(args.imap_host, args.imap_user, args.imap_password, ssl)
-    srv.select_folder('INBOX')
+        initdb(dbname, compact=args.compact)
+
+    if args.rules:
+        _rules = load_rules(args.rules)
+
+    conn = connect(dbname)
+    if args.events:
+        set_events(conn, read_events(args.events))
+    upgradedb(conn)
+    _events = load_events(conn, Event(EVENT, START, STOP, channel=args.channel,
+                                      html=args.html))
+    if args.compact and not conn.compact:
+        print 'Converting the timeline into the compact format.'
+        compact_timeline(conn)
+    _cache = EvaluationCache(dbname, size=args.cache_size, ttl=args.cache_ttl)
+    _titles = EvaluationCache(size=args.cache_size, ttl=args.cache_ttl)
+    _bugzilla = bzclient.Client(args.bz_host, args.bz_user, args.bz_password,
+                                size=args.bz_workers, chunk=BZ_CHUNK)
+
+    if args.search:
+        found = search(dbname, args.search, args.page, size=20)
+        if found is None:
+            print 'Search not available: SQLite has no full-text search (FTS5).'
+            sys.exit(1)
+        results, more = found
+        for date_, bugid, who, subject in results:
+            print '%s BNC#%s %s: %s' % (date_, bugid, who, subject)
+        if more:
+            print '(more results with --page %d)' % (args.page + 1)
+        sys.exit(0)
+
+    if args.import_path:
+        print 'Importing %s...' % args.import_path
+        start = time.time()
+        imported, skipped = import_mail(conn, args.import_path, processes=args.jobs,
+                                        all_bodies=args.all_bodies)
+        print '%d bug actions imported in %.1fs (%d mails skipped).' % (
+            imported, time.time() - start, skipped)
+        sys.exit(0)
+
+    if args.replay:
+        print 'Replaying the timeline...'
+        print '%d bug actions replayed.' % replay(conn, dbname, processes=args.jobs)
+        sys.exit(0)
+
+    leaderboards = collections.OrderedDict(
+        (event.name, Leaderboard(dbname, event)) for event in _events)
+    publishing = threading.Lock()
+
+    def refresh():
+        # Called by the IMAP loop and by the writer for the pushed mails
+        with publishing:
+            publish(leaderboards)
+            if args.metrics_file:
+                _metrics.write(args.metrics_file)
+
+    if args.http_port:
+        server = LeaderboardServer(args.http_port, leaderboards)
+        publish(leaderboards)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
 
     # Start IRC bot
-    bot = BugBot(IRC_CHANNEL, IRC_NICK, IRC_HOST, dbname=dbname)
+    channels = []
+    for event in _events:
+        if event.channel and event.channel not in channels:
+            channels.append(event.channel)
+    bot = BugBot(channels, IRC_NICK, IRC_HOST, dbname=dbname)
     thread = BugBotThread(bot)
     thread.start()
 
-    print 'Processing new messages to arrive...'
+    pipeline = Pipeline(dbname, bot=bot, workers=args.bz_workers, committed=refresh)
+    bot.pipeline = pipeline
+
+    for stage in ('evaluate', 'write', 'flag'):
+        _metrics.gauge('pipeline_%s_chunks' % stage,
+                       lambda stage=stage: pipeline.depths()[stage])
+    if args.push_port:
+        listener = PushListener(args.push_port)
+        _metrics.gauge('push_queue_messages', listener.queue.qsize)
+        for target, targs in ((listener.run, ()),
+                              (push_ingest, (listener, pipeline, args.all_bodies))):
+            thread = threading.Thread(target=target, args=targs)
+            thread.daemon = True
+            thread.start()
+
+    for key in ('size', 'hits', 'misses', 'evictions'):
+        _metrics.gauge('cache_%s' % key, lambda key=key: _cache.stats()[key])
+        _metrics.gauge('title_cache_%s' % key, lambda key=key: _titles.stats()[key])
+    _metrics.gauge('output_queue_messages', lambda: len(bot.queue))
+    _metrics.gauge('bugzilla_sessions', lambda: _bugzilla.sessions)
+    for key in ('calls', 'errors', 'retries'):
+        _metrics.gauge('bugzilla_%s' % key, lambda key=key: sum(
+            stats[key] for stats in _bugzilla.stats().itervalues()))
+
+    criteria = (
+        'NOT DELETED',
+        'FROM %s' % BZ_SENDER,
+    )
+
     while True:
-        # Process all the unread messages
-        criteria = (
-            'NOT DELETED', 
-            'UNSEEN',
-            'FROM bugzilla_noreply@novell.com',
-        )
-        process(dbname, srv.search(criteria), bot=bot)
-        with open(HTML, 'w') as f:
-            print >>f, ranking(dbname, html=True)
-
-        # Go to IDLE mode
-        srv.idle()
-        response = srv.idle_check(timeout=300)
-        srv.idle_done()
-
-        # if response:
-        #     process(dbname, [r[0] for r in response if r[1] == 'EXISTS'], bot=bot)
-        #     with open(HTML, 'w') as f:
-        #         print >>f, ranking(dbname, html=True)
-
-    srv.idle_done()
+        try:
+            srv = login(args.imap_host, args.imap_user, args.imap_password, ssl)
+            folder = srv.select_folder('INBOX')
+
+            # UIDs are only meaningful for the same UIDVALIDITY
+            uidvalidity = str(folder['UIDVALIDITY'])
+            with conn:
+                if get_state(conn, 'uidvalidity') != uidvalidity:
+                    set_state(conn, 'uidvalidity', uidvalidity)
+                    set_state(conn, 'last_uid', 0)
+
+            # After a (re)connection, process all the unread messages.
+            # The ones up to the last_uid checkpoint were committed
+            # before a crash, but not flagged: flag them without
+            # fetching them again.
+            with _metrics.timer('imap_search_seconds'):
+                uids = srv.search(criteria + ('UNSEEN',))
+            last_uid = int(get_state(conn, 'last_uid', 0))
+            committed = [uid for uid in uids if uid <= last_uid]
+            if committed:
+                print 'Flagging %d messages committed before a restart...' % len(committed)
+                srv.add_flags(committed, ['\\Seen'])
+                _metrics.count('resumed', len(committed))
+            pipeline.run(srv, [uid for uid in uids if uid > last_uid],
+                         all_bodies=args.all_bodies, uidvalidity=uidvalidity)
+            refresh()
+
+            print 'Processing new messages to arrive...'
+            while True:
+                # Go to IDLE mode
+                srv.idle()
+                response = srv.idle_check(timeout=300)
+                srv.idle_done()
+
+                # Fetch only what arrived after the last processed UID
+                if any(r[1] == 'EXISTS' for r in response):
+                    last_uid = int(get_state(conn, 'last_uid', 0))
+                    with _metrics.timer('imap_search_seconds'):
+                        uids = srv.search(('UID %d:*' % (last_uid + 1),) + criteria)
+                    pipeline.run(srv, [uid for uid in uids if uid > last_uid],
+                                 all_bodies=args.all_bodies,
+                                 uidvalidity=uidvalidity)
+                    refresh()
+        except (IMAPClient.Error, socket.error), e:
+            print 'IMAP connection lost (%s), reconnecting...' % e
+            time.sleep(10)
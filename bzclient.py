@@ -0,0 +1,147 @@
+import Queue
+import threading
+import time
+
+
+try:
+    import suse.bugzilla
+except ImportError, e:
+    print """*** please git clone git://bolzano/suse/solid-ground
+*** then symlink the suse subdir here"""
+    raise
+
+URL = 'https://apibugzilla.novell.com'
+
+# Maximum number of authenticated sessions kept open
+POOL_SIZE = 4
+
+# Maximum number of bugs asked in a single get_bugs() request
+CHUNK = 100
+
+# Attempts for each request, and delay before the first retry (doubled
+# after each failure)
+RETRIES = 3
+BACKOFF = 1.0
+
+
+class Client(object):
+    """Bugzilla client sharing a bounded pool of sessions.
+
+    Every suse.bugzilla.Bugzilla instance keeps its login and its HTTP
+    connection, so a session is created (and authenticated) only when
+    all the existing ones are busy and the pool is not full. A session
+    that failed a request is dropped, and the request is retried with a
+    new one after an exponential backoff.
+
+    The client is thread-safe; at most `size` requests run at the same
+    time.
+
+    """
+
+    def __init__(self, base=URL, username='X', password='X', size=POOL_SIZE,
+                 chunk=CHUNK, retries=RETRIES, backoff=BACKOFF):
+        self.base = base
+        self.username = username
+        self.password = password
+        self.size = size
+        self.chunk = chunk
+        self.retries = retries
+        self.backoff = backoff
+        # LIFO, so that the most recently used session (the one whose
+        # connection is most likely still open) is reused first
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.sessions = 0
+
+    def _session(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            bz = suse.bugzilla.Bugzilla(None, None, base=self.base)
+            bz.browser.add_password(self.base, self.username, self.password)
+            with self._lock:
+                self.sessions += 1
+            return bz
+
+    def _record(self, method, elapsed, retries, failed):
+        with self._lock:
+            stats = self._stats.setdefault(method, {
+                'calls': 0, 'errors': 0, 'retries': 0,
+                'time': 0.0, 'max': 0.0,
+            })
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['retries'] += retries
+            stats['time'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+
+    def call(self, method, *args, **kwargs):
+        """Call a suse.bugzilla.Bugzilla method using a pooled session.
+
+        Arguments:
+            method -- name of the method (e.g. 'get_bugs')
+
+        Returns:
+            The result of the method. The last error is raised if all
+            the attempts fail.
+
+        """
+        delay = self.backoff
+        with self._slots:
+            for attempt in range(self.retries):
+                bz = self._session()
+                start = time.time()
+                try:
+                    result = getattr(bz, method)(*args, **kwargs)
+                except Exception, e:
+                    self._record(method, time.time() - start, int(attempt > 0), 1)
+                    with self._lock:
+                        self.sessions -= 1
+                    if attempt + 1 == self.retries:
+                        raise
+                    print 'Bugzilla %s failed (%s), retrying in %gs' % (method, e, delay)
+                    time.sleep(delay)
+                    delay *= 2
+                else:
+                    self._record(method, time.time() - start, int(attempt > 0), 0)
+                    self._idle.put(bz)
+                    return result
+
+    def get_bugs(self, ids):
+        """Get several bugs, in requests of at most `chunk` ids.
+
+        Arguments:
+            ids -- iterable of bug numbers
+
+        Returns:
+            List of the bugs returned by Bugzilla.
+
+        """
+        ids = list(ids)
+        bugs = []
+        for i in range(0, len(ids), self.chunk):
+            bugs.extend(self.call('get_bugs', ids=ids[i:i+self.chunk]))
+        return bugs
+
+    def update_bug(self, bugid, **kwargs):
+        """Update a bug (see suse.bugzilla.Bugzilla.update_bug)."""
+        return self.call('update_bug', bugid, **kwargs)
+
+    def stats(self):
+        """Return the request statistics, by method.
+
+        Returns:
+            Dictionary of method name to a dictionary with the number
+            of calls, errors and retries, and the average and maximum
+            time of a request in seconds.
+
+        """
+        with self._lock:
+            result = {}
+            for method, stats in self._stats.iteritems():
+                stats = dict(stats)
+                stats['avg'] = stats.pop('time') / stats['calls']
+                result[method] = stats
+            return result
@@ -1,34 +1,137 @@
 import argparse
+import collections
 import csv
+import Queue
+import sys
+import threading
 
+import bzclient
 
-try:
-    import suse.bugzilla
-except ImportError, e:
-    print """*** please git clone git://bolzano/suse/solid-ground
-*** then symlink the suse subdir here"""
-    raise
 
-URL = 'https://apibugzilla.novell.com'
+def read_ids(filename, chunk):
+    """Read the bug ids of a CSV file, without loading all of it.
+
+    Arguments:
+        filename -- CSV file with the evaluation
+        chunk    -- number of ids in each yielded list
+
+    Returns:
+        Generator of lists of bug ids.
+
+    """
+    ids = []
+    with open(filename) as f:
+        for row in csv.reader(f):
+            if row and row[0].isdigit():
+                ids.append(row[0])
+                if len(ids) == chunk:
+                    yield ids
+                    ids = []
+    if ids:
+        yield ids
+
+
+def lookup(bz, chunks, jobs):
+    """Get the bugs of several chunks of ids concurrently.
+
+    At most `jobs` chunks are waiting to be looked up, so memory does
+    not depend on the size of the input.
+
+    Arguments:
+        bz     -- bzclient.Client instance
+        chunks -- iterable of lists of bug ids
+        jobs   -- number of concurrent requests
+
+    Returns:
+        Generator of (ids, bugs, error) tuples, in completion order.
+        `bugs` is None if the lookup failed with `error`. An error
+        reading `chunks` is raised again once the workers are done.
+
+    """
+    pending = Queue.Queue(jobs)
+    results = Queue.Queue(jobs)
+    failure = []
+
+    def worker():
+        while True:
+            ids = pending.get()
+            if ids is None:
+                results.put(None)
+                return
+            try:
+                results.put((ids, bz.get_bugs(ids), None))
+            except Exception, e:
+                results.put((ids, None, e))
+
+    def reader():
+        try:
+            for ids in chunks:
+                pending.put(ids)
+        except Exception:
+            failure.append(sys.exc_info())
+        finally:
+            # The workers always stop, or the results would never end
+            for _ in range(jobs):
+                pending.put(None)
+
+    threads = [threading.Thread(target=worker) for _ in range(jobs)]
+    threads.append(threading.Thread(target=reader))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running = jobs
+    while running:
+        result = results.get()
+        if result is None:
+            running -= 1
+        else:
+            yield result
+    if failure:
+        raise failure[0][0], failure[0][1], failure[0][2]
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Import CSV bug evaluation into BNC.')
+    parser = argparse.ArgumentParser(description='Check the product of the bugs of a CSV bug evaluation.')
     parser.add_argument('cvsfile', metavar='FILE', type=str,
                         help='CVS file with the evaluation')
+    parser.add_argument('--bz-host', default=bzclient.URL, help='bugzilla server')
+    parser.add_argument('-j', '--jobs', type=int, default=bzclient.POOL_SIZE,
+                        help='number of concurrent Bugzilla requests')
+    parser.add_argument('--chunk', type=int, default=bzclient.CHUNK,
+                        help='number of bugs asked in each request')
+    parser.add_argument('--csv', action='store_true',
+                        help='write "bug,classification,product" CSV rows '
+                        'instead of the report')
     args = parser.parse_args()
 
-    bugs = {}
+    bz = bzclient.Client(args.bz_host, size=args.jobs, chunk=args.chunk)
+    out = csv.writer(sys.stdout) if args.csv else None
+    groups = collections.Counter()
+    missing = failed = 0
 
-    with open(args.cvsfile) as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if row[0].isdigit():
-                bugs[row[0]] = row[8]
+    for ids, bugs, error in lookup(bz, read_ids(args.cvsfile, args.chunk), args.jobs):
+        if bugs is None:
+            print >>sys.stderr, 'Error looking up %d bugs (%s): %s' % (
+                len(ids), ' '.join(ids), error)
+            failed += len(ids)
+            continue
+        missing += len(set(ids) - set(str(bug.bug_id) for bug in bugs))
+        for bug in bugs:
+            product = getattr(bug, 'product', '')
+            groups[bug.classification, product] += 1
+            if out:
+                out.writerow((bug.bug_id, bug.classification, product))
+            else:
+                print bug.bug_id, bug.classification, product
 
-    bz = suse.bugzilla.Bugzilla(None, None, base=URL)
-    bz.browser.add_password(URL, 'X', 'X')
-    all_bugs = bz.get_bugs(ids=bugs.keys())
-    for bug in all_bugs:
-        print bug.bug_id, bug.classification
-# '[%s]'%bug.status_whiteboard if hasattr(bug, 'status_whiteboard') else '--EMPTY--'
+    if not out:
+        print
+        for (classification, product), count in sorted(groups.iteritems()):
+            print '%6d %s / %s' % (count, classification, product)
+        print '%6d not found' % missing
+    elif missing:
+        print >>sys.stderr, '%d bugs not found' % missing
+    if failed:
+        print >>sys.stderr, '%d bugs could not be looked up' % failed
+        raise SystemExit(1)
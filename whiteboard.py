@@ -1,21 +1,108 @@
 import argparse
 import csv
+import Queue
+import sys
+import threading
 
+import bzclient
 
-try:
-    import suse.bugzilla
-except ImportError, e:
-    print """*** please git clone git://bolzano/suse/solid-ground
-*** then symlink the suse subdir here"""
-    raise
 
-URL = 'https://apibugzilla.novell.com'
+# Evaluation tokens managed in the status whiteboard
+EVALUATIONS = ('GOLD', 'SILVER', 'BRONZE')
+
+
+def plan(bug, evaluation):
+    """Compute the whiteboard updates needed by a bug.
+
+    The first token to remove and the token to add are merged in a
+    single update. A whiteboard that already has the wanted evaluation
+    is left untouched, so running the sync again after a partial
+    failure only updates the bugs that were not finished.
+
+    Arguments:
+        bug        -- Bugzilla bug
+        evaluation -- wanted evaluation (GOLD, SILVER, BRONZE or empty)
+
+    Returns:
+        List of update_bug() keyword arguments (empty if the bug is
+        already up to date).
+
+    """
+    whiteboard = getattr(bug, 'status_whiteboard', '')
+    if evaluation and evaluation in whiteboard:
+        return []
+
+    updates = [{'whiteboard_remove': i} for i in EVALUATIONS if i in whiteboard]
+    if evaluation:
+        if updates:
+            updates[0]['whiteboard_add'] = evaluation
+        else:
+            updates.append({'whiteboard_add': evaluation})
+    return updates
+
+
+def describe(update):
+    """Return a short description of an update (e.g. '-SILVER +GOLD')."""
+    desc = []
+    if 'whiteboard_remove' in update:
+        desc.append('-' + update['whiteboard_remove'])
+    if 'whiteboard_add' in update:
+        desc.append('+' + update['whiteboard_add'])
+    return ' '.join(desc)
+
+
+def sync(bz, changes, jobs):
+    """Send the updates of several bugs concurrently.
+
+    Arguments:
+        bz      -- bzclient.Client instance
+        changes -- list of (bugid, updates) tuples
+        jobs    -- maximum number of concurrent updates
+
+    Returns:
+        List of the bugs whose update failed.
+
+    """
+    queue = Queue.Queue()
+    for change in changes:
+        queue.put(change)
+    failed = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                bugid, updates = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                for update in updates:
+                    bz.update_bug(bugid, **update)
+            except Exception, e:
+                with lock:
+                    print bugid, 'ERROR', e
+                    failed.append(bugid)
+            else:
+                with lock:
+                    print bugid, 'UPDATE', ' '.join(describe(u) for u in updates)
+
+    threads = [threading.Thread(target=worker) for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Import CSV bug evaluation into BNC.')
     parser.add_argument('cvsfile', metavar='FILE', type=str,
                         help='CVS file with the evaluation')
+    parser.add_argument('--bz-host', default=bzclient.URL, help='bugzilla server')
+    parser.add_argument('-j', '--jobs', type=int, default=bzclient.POOL_SIZE,
+                        help='maximum number of concurrent updates')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only show the updates that would be done')
     args = parser.parse_args()
 
     bugs = {}
@@ -26,22 +113,32 @@ if __name__ == '__main__':
             if row[0].isdigit():
                 bugs[row[0]] = row[8]
 
-    bz = suse.bugzilla.Bugzilla(None, None, base=URL)
-    bz.browser.add_password(URL, 'X', 'X')
-    all_bugs = bz.get_bugs(ids=bugs.keys())
-    for bug in all_bugs:
-        print bug.bug_id, '[%s]'%bug.status_whiteboard if hasattr(bug, 'status_whiteboard') else '--EMPTY--'
-
-        if hasattr(bug, 'status_whiteboard') and \
-           bugs[bug.bug_id] and \
-           bugs[bug.bug_id] in bug.status_whiteboard:
-            print 'CONTINUE'
-            continue
-        else:
-            for i in ('GOLD', 'SILVER', 'BRONZE'):
-                if hasattr(bug, 'status_whiteboard') and i in bug.status_whiteboard:
-                    print 'REMOVE / UPDATE'
-                    bz.update_bug(bug.bug_id, whiteboard_remove=i)
-            if bugs[bug.bug_id]:
-                print 'ADD'
-                bz.update_bug(bug.bug_id, whiteboard_add=bugs[bug.bug_id])
+    bz = bzclient.Client(args.bz_host, size=args.jobs)
+
+    # Compare the current whiteboards with the CSV before touching
+    # anything
+    changes = []
+    found = set()
+    for bug in bz.get_bugs(bugs.keys()):
+        bugid = str(bug.bug_id)
+        found.add(bugid)
+        updates = plan(bug, bugs[bugid])
+        if updates:
+            changes.append((bugid, updates))
+    # Private or deleted bugs are not returned, and cannot be updated
+    missing = sorted(set(bugs) - found, key=int)
+
+    print '%d bugs, %d up to date, %d to update (%d requests), %d not found' % (
+        len(bugs), len(found) - len(changes), len(changes),
+        sum(len(updates) for _, updates in changes), len(missing))
+    if missing:
+        print >>sys.stderr, '%d bugs not found: %s' % (len(missing), ' '.join(missing))
+
+    if args.dry_run:
+        for bugid, updates in sorted(changes, key=lambda c: int(c[0])):
+            print bugid, ' '.join(describe(u) for u in updates)
+    else:
+        failed = sync(bz, changes, args.jobs)
+        if failed:
+            print '%d updates failed, run again to retry them' % len(failed)
+            raise SystemExit(1)